@@ -1,65 +1,1173 @@
 from .file_utils import *
-from .misc_utils import MD5, Attempt
+from .misc_utils import MD5, BLAKE2B, XXH3, Attempt
 from .serialize_utils import LoadPickle, SavePickle, LoadJson, SaveJson
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+import functools
+import hashlib
+import inspect
+import json
+import mmap
+import asyncio
+import atexit
+import pickle
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+Import("fcntl",globals())
+Import("zstandard",globals())
+Import("lz4.frame@lz4frame",globals())
 
-def CacheInit(path, clear=True, rm=False):
+CACHE_CONFIG_FILE = "cache_config.json"
+CACHE_CLEAN_FILE = "cache.clean"
+CACHE_RESERVED_FILES = [CACHE_CONFIG_FILE, CACHE_CLEAN_FILE, "locks", "sessions", "meta.db", "meta.db-wal", "meta.db-shm"]
+CACHE_MISSING = object()
+
+def cache_remove(file):
+    try:
+        os.remove(file)
+    except FileNotFoundError:
+        pass
+
+def cache_map(f, items, workers=None):
+    if workers is None or workers <= 1 or len(items) <= 1:
+        return [f(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(f, items))
+
+def cache_imap(f, items, workers=None):
+    # Stream `f(item)` in order, with at most `2*workers` items in flight, so that a long iterator of items is never materialized
+    if workers is None or workers <= 1:
+        yield from map(f, items); return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        window = deque()
+        for item in items:
+            window.append(executor.submit(f, item))
+            if len(window) >= 2*workers:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+def cache_scandir(folder):
+    try:
+        with os.scandir(folder) as it:
+            yield from it
+    except FileNotFoundError:
+        return
+
+def cache_empty(path):
+    # Stop at the first entry which is not reserved, so that large cache paths are not listed
+    return not any(entry.name not in CACHE_RESERVED_FILES for entry in cache_scandir(path))
+
+class SQLiteConnections(object):
+    """Per-thread connections to a `sqlite3` database in WAL mode, since `sqlite3` connections can not be shared between threads or forked processes."""
+    def __init__(self, db, schema=list(), timeout=60.0, synchronous="NORMAL"):
+        """
+        Args:
+            db (str): The database file.
+            schema (list): The statements to execute on each new connection, e.g., creating tables if they do not exist.
+            timeout (float): How long a connection waits for the lock of the database before raising an error.
+            synchronous (str): The `synchronous` pragma of the connections, `FULL` syncs every transaction to the disk.
+        """
+        self.db = db; self.schema = schema; self.timeout = timeout; self.synchronous = synchronous
+        self.local = threading.local(); self.conns = list(); self.lock = threading.Lock()
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.db, timeout=self.timeout, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            for statement in self.schema:
+                conn.execute(statement)
+            conn.commit()
+            self.local.conn = conn; self.local.pid = os.getpid()
+            with self.lock:
+                self.conns.append(conn)
+        return conn
+
+    def close(self):
+        with self.lock:
+            for conn in self.conns:
+                conn.close()
+            self.conns = list()
+        self.local = threading.local()
+
+# Encoded entries start with `CACHE_FRAME_MAGIC`, followed by the codec id, the crc32 checksum of the payload and the payload
+# Entries written by older versions are either `CACHE_FRAME_MAGIC_V1` frames without a checksum or plain pickles (which never start with a magic)
+CACHE_FRAME_MAGIC = b"PHC\x02"
+CACHE_FRAME_MAGIC_V1 = b"PHC\x01"
+CACHE_CODECS = {
+    'none': (0, lambda data, level: data, lambda data: data),
+    'zlib': (1, lambda data, level: zlib.compress(data, 6 if level is None else level), lambda data: zlib.decompress(data)),
+    'zstd': (2, lambda data, level: zstandard.ZstdCompressor(level=3 if level is None else level).compress(data), lambda data: zstandard.ZstdDecompressor().decompress(data)),
+    'lz4': (3, lambda data, level: lz4frame.compress(data, compression_level=0 if level is None else level), lambda data: lz4frame.decompress(data)),
+}
+CACHE_CODEC_PACKAGES = {'zstd': ('zstandard', 'zstandard'), 'lz4': ('lz4frame', 'lz4')}
+CACHE_CODEC_IDS = {codec[0]: name for name, codec in CACHE_CODECS.items()}
+def cache_encode(obj, codec=None):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL); codec = dict() if codec is None else codec
+    name = codec.get('name', 'none') if len(data) >= codec.get('threshold', 0) else 'none'
+    data = CACHE_CODECS[name][1](data, codec.get('level', None))
+    return CACHE_FRAME_MAGIC + bytes([CACHE_CODECS[name][0]]) + zlib.crc32(data).to_bytes(4, 'big') + data
+
+def cache_decode(data):
+    n = len(CACHE_FRAME_MAGIC)
+    if data[:n] == CACHE_FRAME_MAGIC:
+        assert (len(data) >= n+5 and zlib.crc32(data[n+5:]) == int.from_bytes(data[n+1:n+5], 'big')), ("Checksum mismatch, the cache entry is corrupted!")
+        data = CACHE_CODECS[CACHE_CODEC_IDS[data[n]]][2](data[n+5:])
+    elif data[:n] == CACHE_FRAME_MAGIC_V1:
+        data = CACHE_CODECS[CACHE_CODEC_IDS[data[n]]][2](data[n+1:])
+    return pickle.loads(data)
+
+def cache_decode_or(data, default=None):
+    try:
+        return cache_decode(data)
+    except Exception:
+        return default  # Corrupted entries are treated as misses
+
+CACHE_KEY_HASHES = {
+    'md5': lambda key: str(MD5(key)),
+    'blake2b-v1': BLAKE2B,
+    'xxh3-v1': XXH3,
+}
+
+class CacheStore(object):
+    """The base class of cache store backends.
+
+    A store is bound to a cache path and manages how the entries under that path are persisted. Entries are addressed by the hash `h` of their keys. Subclasses should be registered using `RegisterCacheBackend` so that they can be selected by name in `CacheInit`.
+    """
+    def __init__(self, path, config=dict()):
+        """
+        Args:
+            path (str): The cache path.
+            config (dict): The configuration of the cache path, as saved in `cache_config.json`.
+        """
+        self.path = path; self.config = config; self.memory = None; self.meta = None; self.stats = None
+        self.hash = CACHE_KEY_HASHES[config.get('key_hash', 'md5')]; self.codec = config.get('codec', None); self.fsync = config.get('fsync', False)
+
+    def exist(self, h):
+        """Check whether the entry with hash `h` exists."""
+        raise NotImplementedError
+
+    def get(self, h, default=None, load_func=LoadPickle):
+        """Load the value of the entry with hash `h`, return `default` if it does not exist or is corrupted."""
+        raise NotImplementedError
+
+    def set(self, h, key, value, save_func=SavePickle):
+        """Save the key and the value of the entry with hash `h` atomically, return the size of the entry in bytes. Readers should never observe a partially written entry."""
+        raise NotImplementedError
+
+    def size(self, h):
+        """Get the size in bytes of the entry with hash `h`."""
+        return 0
+
+    def delete(self, h, rm=True):
+        """Delete the entry with hash `h`."""
+        raise NotImplementedError
+
+    def entries(self, load_func=LoadPickle, ordered=False, workers=None):
+        """Iterate over `(h, key)` of all entries without loading their values. If `ordered` is True, the entries are sorted by `h`, otherwise they are streamed in storage order. Stores with multiple partitions may scan `workers` partitions in parallel."""
+        raise NotImplementedError
+
+    def get_many(self, hs, default=None, load_func=LoadPickle, workers=None):
+        """Load the values of a list of entries, in the same order as `hs`. Subclasses may override this to group the I/O."""
+        return cache_map(lambda h: self.get(h, default=default, load_func=load_func), hs, workers=workers)
+
+    def set_many(self, items, save_func=SavePickle, workers=None):
+        """Save a list of `(h, key, value)` entries, return the sizes of the entries in bytes. Subclasses may override this to group the I/O."""
+        return cache_map(lambda item: self.set(*item, save_func=save_func), items, workers=workers)
+
+    def delete_many(self, hs, rm=True, workers=None):
+        """Delete a list of entries. Subclasses may override this to group the I/O."""
+        cache_map(lambda h: self.delete(h, rm=rm), hs, workers=workers)
+
+    def recover(self, sweep_locks=False):
+        """Remove broken entries left by interrupted writes. If `sweep_locks` is True, also remove the `.lock` files under the cache path."""
+        if sweep_locks:
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    if entry.name.endswith('.lock'):
+                        cache_remove(entry.path)
+
+    def close(self):
+        """Release the resources held by the store."""
+        pass
+
+CACHE_LAYOUTS = ['flat', 'sharded']
+class FileCacheStore(CacheStore):
+    """The default cache store. Each entry is saved as a pair of files `<hash>.key` and `<hash>.value` under the cache path.
+
+    With the `flat` layout (default), all files are saved directly under the cache path. With the `sharded` layout, the files are spread over two levels of sub-folders named by hex prefixes (`<path>/ab/cd/<hash>.key`, derived from a crc32 of the hash), which keeps each folder small for caches with millions of entries. Please refer to `CacheMigrateLayout` for converting between layouts.
+
+    With the default `load_func` and `save_func` (`LoadPickle` and `SavePickle`), the files are encoded with the codec of the cache path and carry a checksum. Custom `load_func` and `save_func` are used as they are.
+
+    Each file is written to a temporary file first and then moved into place with `os.replace`. The value file is written before the key file, and the key file is removed before the value file, so the key file serves as the commit marker of the entry: an entry exists if and only if its key file exists, and its value file is then complete.
+    """
+    def __init__(self, path, config=dict()):
+        super().__init__(path, config)
+        self.layout = config.get('layout', 'flat')
+
+    def file(self, h, ext, layout=None):
+        if (self.layout if layout is None else layout) == 'sharded':
+            shard = format(zlib.crc32(h.encode('utf-8')) & 0xffff, '04x')
+            return os.path.join(self.path, shard[:2], shard[2:], f"{h}.{ext}")
+        return os.path.join(self.path, f"{h}.{ext}")
+
+    def folders(self, layout=None):
+        # The folders containing entries, streamed so that the shards can be scanned in parallel
+        if (self.layout if layout is None else layout) != 'sharded':
+            yield self.path; return
+        for top in cache_scandir(self.path):
+            if len(top.name) == 2 and all(c in '0123456789abcdef' for c in top.name) and top.is_dir():
+                for sub in cache_scandir(top.path):
+                    if len(sub.name) == 2 and all(c in '0123456789abcdef' for c in sub.name) and sub.is_dir():
+                        yield sub.path
+
+    def read(self, file, load_func=LoadPickle):
+        if load_func is not LoadPickle:
+            value = load_func(file)
+            if self.stats is not None:
+                self.stats.count(bytes_read=os.path.getsize(file))
+            return value
+        with open(file, "rb") as f:
+            data = f.read()
+        if self.stats is not None:
+            self.stats.count(bytes_read=len(data))
+        return cache_decode(data)
+
+    def write(self, obj, file, save_func=SavePickle):
+        tmp = f"{file}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            if save_func is not SavePickle:
+                if self.layout == 'sharded':
+                    os.makedirs(os.path.dirname(tmp), exist_ok=True)
+                save_func(obj, tmp); size = os.path.getsize(tmp)
+                if self.fsync:
+                    with open(tmp, "rb+") as f:
+                        os.fsync(f.fileno())
+            else:
+                data = cache_encode(obj, self.codec); size = len(data)
+                try:
+                    f = open(tmp, "wb")
+                except FileNotFoundError:
+                    os.makedirs(os.path.dirname(tmp), exist_ok=True); f = open(tmp, "wb")
+                with f:
+                    f.write(data)
+                    if self.fsync:
+                        f.flush(); os.fsync(f.fileno())
+            os.replace(tmp, file)
+        except BaseException:
+            cache_remove(tmp); raise
+        return size
+
+    def sync(self, file):
+        # Persist the renames of the directory entries
+        if self.fsync and hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(os.path.dirname(file), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def exist(self, h):
+        return os.path.isfile(self.file(h, 'key'))
+
+    def get(self, h, default=None, load_func=LoadPickle):
+        if not self.exist(h):
+            return default
+        try:
+            return self.read(self.file(h, 'value'), load_func=load_func)
+        except FileNotFoundError:
+            return default  # Deleted after the existence check
+        except Exception:
+            return default  # Corrupted entries are treated as misses
+
+    def set(self, h, key, value, save_func=SavePickle):
+        # The key file is written last as the commit marker of the entry
+        size = self.write(value, self.file(h, 'value'), save_func=save_func)
+        size += self.write(key, self.file(h, 'key'), save_func=save_func)
+        self.sync(self.file(h, 'key'))
+        return size
+
+    def size(self, h):
+        try:
+            return os.path.getsize(self.file(h, 'key')) + os.path.getsize(self.file(h, 'value'))
+        except OSError:
+            return 0
+
+    def delete(self, h, rm=True):
+        # Several processes may delete the same entry at the same time (e.g., evicting the same victims), so missing files are ignored
+        for ext in ['key', 'value']:
+            if rm:
+                cache_remove(self.file(h, ext))
+            else:
+                Delete(self.file(h, ext), rm=rm)
+
+    def scan(self, files, load_func=LoadPickle):
+        for h, file in files:
+            try:
+                key = self.read(file, load_func=load_func)
+            except Exception:
+                continue    # Deleted during the iteration, or corrupted
+            yield (h, key)
+
+    def entries(self, load_func=LoadPickle, ordered=False, workers=None):
+        def keys(folder):
+            return ((entry.name[:-len('.key')], entry.path) for entry in cache_scandir(folder) if entry.name.endswith('.key'))
+        if ordered:
+            yield from self.scan(sorted(file for folder in self.folders() for file in keys(folder)), load_func=load_func); return
+        if workers is None or workers <= 1:
+            for folder in self.folders():
+                yield from self.scan(keys(folder), load_func=load_func)
+            return
+        for entries in cache_imap(lambda folder: list(self.scan(keys(folder), load_func=load_func)), self.folders(), workers=workers):
+            yield from entries
+
+    def recover(self, sweep_locks=False):
+        # Since entries are committed atomically, recovery only collects garbage: temporary files of interrupted writes, and key files or value files without their counterparts, in a single pass over the directory
+        if self.layout == 'sharded':
+            for entry in cache_scandir(self.path):
+                if entry.name.endswith('.tmp') or (sweep_locks and entry.name.endswith('.lock')):
+                    cache_remove(entry.path)
+        for folder in self.folders():
+            keys = set(); values = set(); locks = list()
+            for entry in cache_scandir(folder):
+                name = entry.name
+                if name.endswith('.tmp'):
+                    cache_remove(entry.path)
+                elif name.endswith('.key'):
+                    keys.add(name[:-len('.key')])
+                elif name.endswith('.value'):
+                    values.add(name[:-len('.value')])
+                elif sweep_locks and name.endswith('.lock'):
+                    locks.append(entry.path)
+            for h in keys - values:
+                cache_remove(self.file(h, 'key'))
+            for h in values - keys:
+                cache_remove(self.file(h, 'value'))
+            for file in locks:
+                cache_remove(file)
+
+    def move(self, src, dst):
+        try:
+            os.replace(src, dst)
+        except FileNotFoundError:
+            if not os.path.exists(src):
+                return  # Already moved together with its counterpart
+            os.makedirs(os.path.dirname(dst), exist_ok=True); os.replace(src, dst)
+
+    def relayout(self, source, workers=None):
+        """Move all the entries saved in the `source` layout into the layout of the store, in place. The value file of each entry is moved before its key file, so that an interrupted migration never exposes partial entries and can be resumed."""
+        def relayout_folder(folder):
+            for entry in cache_scandir(folder):
+                name = entry.name
+                if name.endswith('.tmp'):
+                    cache_remove(entry.path)
+                elif name.endswith('.key'):
+                    h = name[:-len('.key')]
+                    self.move(os.path.join(folder, f"{h}.value"), self.file(h, 'value'))
+                    self.move(entry.path, self.file(h, 'key'))
+                elif name.endswith('.value'):
+                    h = name[:-len('.value')]
+                    self.move(entry.path, self.file(h, 'value'))
+            if folder != self.path:
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    pass
+        for _ in cache_imap(relayout_folder, list(self.folders(layout=source)), workers=workers):
+            pass
+        if source == 'sharded':
+            for top in cache_scandir(self.path):
+                if len(top.name) == 2 and top.is_dir():
+                    try:
+                        os.rmdir(top.path)
+                    except OSError:
+                        pass
+
+class SQLiteCacheStore(CacheStore):
+    """A single-file cache store based on `sqlite3`. All entries are saved in `cache.db` under the cache path, which avoids creating files per entry.
+
+    Keys and values are kept in two separate tables indexed by the hash, so that lookups are answered by the index and enumerating keys does not read any value payload. The database runs in WAL (write-ahead log) mode, so that writes are appended to the log and readers are not blocked by writers.
+
+    Since keys and values are pickled (and encoded with the codec of the cache path) into the database, `load_func` and `save_func` are ignored by this store.
+    """
+    def __init__(self, path, config=dict()):
+        super().__init__(path, config)
+        self.db = SQLiteConnections(pjoin(path, config.get('db', "cache.db")), schema=[
+            "CREATE TABLE IF NOT EXISTS keys (h TEXT PRIMARY KEY, key BLOB NOT NULL) WITHOUT ROWID",
+            "CREATE TABLE IF NOT EXISTS vals (h TEXT PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID",
+        ], timeout=config.get('timeout', 60.0), synchronous="FULL" if self.fsync else "NORMAL")
+
+    def connect(self):
+        return self.db.connect()
+
+    def exist(self, h):
+        return self.connect().execute("SELECT 1 FROM keys WHERE h=?", (str(h),)).fetchone() is not None
+
+    def get(self, h, default=None, load_func=LoadPickle):
+        row = self.connect().execute("SELECT value FROM vals WHERE h=?", (str(h),)).fetchone()
+        if row is not None and self.stats is not None:
+            self.stats.count(bytes_read=len(row[0]))
+        return cache_decode_or(row[0], default) if row is not None else default
+
+    def set(self, h, key, value, save_func=SavePickle):
+        conn = self.connect(); key = cache_encode(key, self.codec); value = cache_encode(value, self.codec)
+        with conn:
+            # The key is written last, so that an existing key always implies an existing value
+            conn.execute("INSERT OR REPLACE INTO vals (h, value) VALUES (?, ?)", (str(h), value))
+            conn.execute("INSERT OR REPLACE INTO keys (h, key) VALUES (?, ?)", (str(h), key))
+        return len(key) + len(value)
+
+    def delete(self, h, rm=True):
+        conn = self.connect()
+        with conn:
+            conn.execute("DELETE FROM keys WHERE h=?", (str(h),))
+            conn.execute("DELETE FROM vals WHERE h=?", (str(h),))
+
+    def get_many(self, hs, default=None, load_func=LoadPickle, workers=None):
+        conn = self.connect(); values = dict()
+        for i in range(0, len(hs), 512):
+            chunk = [str(h) for h in hs[i:i+512]]
+            for h, value in conn.execute(f"SELECT h, value FROM vals WHERE h IN ({','.join('?'*len(chunk))})", chunk):
+                values[h] = value
+        if self.stats is not None:
+            self.stats.count(bytes_read=sum(len(value) for value in values.values()))
+        return [cache_decode_or(values[str(h)], default) if str(h) in values else default for h in hs]
+
+    def set_many(self, items, save_func=SavePickle, workers=None):
+        conn = self.connect(); items = [(str(h), cache_encode(key, self.codec), cache_encode(value, self.codec)) for h, key, value in items]
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO vals (h, value) VALUES (?, ?)", [(h, value) for h, _, value in items])
+            conn.executemany("INSERT OR REPLACE INTO keys (h, key) VALUES (?, ?)", [(h, key) for h, key, _ in items])
+        return [len(key) + len(value) for _, key, value in items]
+
+    def delete_many(self, hs, rm=True, workers=None):
+        conn = self.connect()
+        with conn:
+            conn.executemany("DELETE FROM keys WHERE h=?", [(str(h),) for h in hs])
+            conn.executemany("DELETE FROM vals WHERE h=?", [(str(h),) for h in hs])
+
+    def entries(self, load_func=LoadPickle, ordered=False, workers=None):
+        cursor = self.connect().execute("SELECT h, key FROM keys" + (" ORDER BY h" if ordered else ""))
+        while True:
+            rows = cursor.fetchmany(1024)
+            if not rows:
+                break
+            for h, key in rows:
+                key = cache_decode_or(key, CACHE_MISSING)
+                if key is not CACHE_MISSING:
+                    yield (h, key)
+
+    def recover(self, sweep_locks=False):
+        super().recover(sweep_locks=sweep_locks); conn = self.connect()
+        with conn:
+            conn.execute("DELETE FROM vals WHERE h NOT IN (SELECT h FROM keys)")
+            conn.execute("DELETE FROM keys WHERE h NOT IN (SELECT h FROM vals)")
+
+    def size(self, h):
+        row = self.connect().execute("SELECT length(value) FROM vals WHERE h=?", (str(h),)).fetchone()
+        return row[0] if row is not None else 0
+
+    def close(self):
+        self.db.close()
+
+class CacheMemory(object):
+    """An in-process LRU memory tier in front of a cache store.
+
+    Values are kept as loaded, without copying, so callers should not modify values returned from the cache in place. The memory tier is not shared between processes: entries written by other processes are only visible after the local copy is evicted.
+    """
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None):
+        """
+        Args:
+            max_entries (int): The maximum number of entries kept in memory. If None, the number of entries is not limited.
+            max_bytes (int): The maximum approximate size in bytes of the values kept in memory. If None, the size is not limited.
+            sizeof: The function to estimate the size of a value in bytes. Default is the length of its pickle. Only used when `max_bytes` is set.
+        """
+        self.max_entries = max_entries; self.max_bytes = max_bytes; self.sizeof = sizeof
+        self.data = OrderedDict(); self.bytes = 0; self.lock = threading.Lock()
+        self.hits = 0; self.misses = 0; self.evictions = 0
+
+    def size(self, value):
+        if self.max_bytes is None:
+            return 0
+        if self.sizeof is not None:
+            return self.sizeof(value)
+        try:
+            return len(pickle.dumps(value))
+        except Exception:
+            return sys.getsizeof(value)
+
+    def get(self, h, default=CACHE_MISSING):
+        with self.lock:
+            item = self.data.get(h, None)
+            if item is not None and item[2] is not None and item[2] <= time.time():
+                del self.data[h]; self.bytes -= item[1]; item = None
+            if item is None:
+                self.misses += 1; return default
+            self.data.move_to_end(h); self.hits += 1; return item[0]
+
+    def put(self, h, value, expire=None):
+        size = self.size(value)
+        with self.lock:
+            item = self.data.pop(h, None)
+            if item is not None:
+                self.bytes -= item[1]
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self.data[h] = (value, size, expire); self.bytes += size
+            while (self.max_entries is not None and len(self.data) > self.max_entries) or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                _, item = self.data.popitem(last=False); self.bytes -= item[1]; self.evictions += 1
+
+    def pop(self, h):
+        with self.lock:
+            item = self.data.pop(h, None)
+            if item is not None:
+                self.bytes -= item[1]
+
+    def clear(self):
+        with self.lock:
+            self.data = OrderedDict(); self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / total) if total > 0 else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self.data),
+                'bytes': self.bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+            }
+
+CACHE_EVICTIONS = ['lru', 'lfu']
+CACHE_POLICY_ARGS = ['max_bytes', 'max_entries', 'ttl', 'eviction', 'check_every']
+class CacheMeta(object):
+    """The metadata index of a cache path with a policy, saved in `meta.db` under the cache path.
+
+    The size, last access time, number of hits and expiration time of every entry are tracked in an indexed table, so that expired entries and eviction victims are found by index scans instead of listing and stat-ing the entries. Accesses are buffered in memory and written in batches.
+    """
+    def __init__(self, path, policy=dict()):
+        """
+        Args:
+            path (str): The cache path.
+            policy (dict): The policy of the cache path. Please refer to `CacheInit`.
+        """
+        self.policy = policy; self.accesses = dict(); self.writes = 0; self.lock = threading.Lock()
+        self.db = SQLiteConnections(pjoin(path, "meta.db"), schema=[
+            "CREATE TABLE IF NOT EXISTS meta (h TEXT PRIMARY KEY, size INTEGER NOT NULL, atime REAL NOT NULL, hits INTEGER NOT NULL, expire REAL) WITHOUT ROWID",
+            "CREATE INDEX IF NOT EXISTS meta_atime ON meta (atime)",
+            "CREATE INDEX IF NOT EXISTS meta_hits ON meta (hits, atime)",
+            "CREATE INDEX IF NOT EXISTS meta_expire ON meta (expire) WHERE expire IS NOT NULL",
+            # The number and total size of the entries are kept up to date by triggers, in the same transaction as the writes
+            "CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), entries INTEGER NOT NULL, bytes INTEGER NOT NULL)",
+            "CREATE TRIGGER IF NOT EXISTS meta_insert AFTER INSERT ON meta BEGIN UPDATE totals SET entries = entries + 1, bytes = bytes + NEW.size WHERE id = 0; END",
+            "CREATE TRIGGER IF NOT EXISTS meta_delete AFTER DELETE ON meta BEGIN UPDATE totals SET entries = entries - 1, bytes = bytes - OLD.size WHERE id = 0; END",
+            "CREATE TRIGGER IF NOT EXISTS meta_update AFTER UPDATE OF size ON meta BEGIN UPDATE totals SET bytes = bytes + NEW.size - OLD.size WHERE id = 0; END",
+        ])
+        conn = self.db.connect()
+        if conn.execute("SELECT 1 FROM totals").fetchone() is None:
+            # Indexes created before the totals were tracked are counted once
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO totals (id, entries, bytes) SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM meta")
+
+    def set_many(self, entries):
+        """Record written `(h, size, expire)` entries, return True if an eviction is due."""
+        conn = self.db.connect(); now = time.time()
+        with conn:
+            # An upsert instead of `INSERT OR REPLACE`, whose implicit deletions do not fire the triggers
+            conn.executemany("INSERT INTO meta (h, size, atime, hits, expire) VALUES (?, ?, ?, 0, ?) ON CONFLICT (h) DO UPDATE SET size = excluded.size, atime = excluded.atime, hits = 0, expire = excluded.expire", [(str(h), size, now, expire) for h, size, expire in entries])
+        with self.lock:
+            self.writes += len(entries)
+            if self.writes < self.policy.get('check_every', 64):
+                return False
+            self.writes = 0; return True
+
+    def delete_many(self, hs):
+        conn = self.db.connect()
+        with self.lock:
+            for h in hs:
+                self.accesses.pop(str(h), None)
+        with conn:
+            conn.executemany("DELETE FROM meta WHERE h=?", [(str(h),) for h in hs])
+
+    def expire_many(self, hs):
+        """Get the expiration times of a list of entries, as a dict from `str(h)`. Entries without expiration time are omitted."""
+        conn = self.db.connect(); expires = dict()
+        for i in range(0, len(hs), 512):
+            chunk = [str(h) for h in hs[i:i+512]]
+            for h, expire in conn.execute(f"SELECT h, expire FROM meta WHERE expire IS NOT NULL AND h IN ({','.join('?'*len(chunk))})", chunk):
+                expires[h] = expire
+        return expires
+
+    def touch(self, h):
+        with self.lock:
+            self.accesses[str(h)] = (self.accesses.get(str(h), (0, 0))[0] + 1, time.time())
+            if len(self.accesses) < 256:
+                return
+            accesses = self.accesses; self.accesses = dict()
+        self.flush(accesses)
+
+    def flush(self, accesses=None):
+        """Write the buffered accesses."""
+        if accesses is None:
+            with self.lock:
+                accesses = self.accesses; self.accesses = dict()
+        if accesses:
+            conn = self.db.connect()
+            with conn:
+                conn.executemany("UPDATE meta SET hits=hits+?, atime=max(atime, ?) WHERE h=?", [(hits, atime, h) for h, (hits, atime) in accesses.items()])
+
+    def victims(self):
+        """Find the expired entries and the entries to be evicted to satisfy the limits of the policy."""
+        conn = self.db.connect()
+        expired = conn.execute("SELECT h, size FROM meta WHERE expire IS NOT NULL AND expire <= ?", (time.time(),)).fetchall(); victims = [h for h, _ in expired]
+        max_entries = self.policy.get('max_entries', None); max_bytes = self.policy.get('max_bytes', None)
+        if max_entries is None and max_bytes is None:
+            return victims
+        entries, total = conn.execute("SELECT entries, bytes FROM totals WHERE id = 0").fetchone()
+        entries -= len(expired); total -= sum(size for _, size in expired)
+        if (max_entries is not None and entries > max_entries) or (max_bytes is not None and total > max_bytes):
+            # The buffered accesses are only needed to order the eviction victims
+            self.flush(); order = "hits, atime" if self.policy.get('eviction', 'lru') == 'lfu' else "atime"; expired = set(victims)
+            for h, size in conn.execute(f"SELECT h, size FROM meta ORDER BY {order}"):
+                if not ((max_entries is not None and entries > max_entries) or (max_bytes is not None and total > max_bytes)):
+                    break
+                if h not in expired:
+                    victims.append(h); entries -= 1; total -= size
+        return victims
+
+    def close(self):
+        self.flush(); self.db.close()
+
+CACHE_STATS_COUNTERS = ['hits', 'misses', 'sets', 'deletes', 'lock_retries', 'bytes_read', 'bytes_written']
+class CacheCounters(object):
+    """In-process statistics of a cache path: operation counters, bytes moved and latency histograms of `CacheGet` and `CacheSet`.
+
+    Latencies are counted in power-of-two buckets, where the `i`-th bucket counts the operations taking less than `2**i` microseconds, so recording is constant time and percentiles are estimated by the upper bounds of the buckets. If `emit_file` is set, a snapshot is appended to the jsonl file at most every `emit_every` seconds (checked when operations are recorded) and when the cache path is closed.
+    """
+    def __init__(self, path, emit_file=None, emit_every=60.0):
+        """
+        Args:
+            path (str): The cache path.
+            emit_file (str): If provided, the jsonl file to append the snapshots to.
+            emit_every (float): The minimum time gap between two snapshots in seconds.
+        """
+        self.path = path; self.emit_file = emit_file; self.emit_every = emit_every
+        self.lock = threading.Lock(); self.reset(); self.next_emit = time.time() + emit_every
+
+    def reset(self):
+        self.counts = {name: 0 for name in CACHE_STATS_COUNTERS}; self.since = time.time(); self.dirty = False
+        self.latency = {'get': [0]*32, 'set': [0]*32}; self.seconds = {'get': 0.0, 'set': 0.0}
+
+    def count(self, **counts):
+        with self.lock:
+            for name, n in counts.items():
+                self.counts[name] += n
+            self.dirty = True
+        if self.emit_file is not None and time.time() >= self.next_emit:
+            self.emit()
+
+    def record(self, op, seconds, **counts):
+        with self.lock:
+            self.latency[op][min(int(seconds*1e6).bit_length(), 31)] += 1; self.seconds[op] += seconds
+        self.count(**counts)
+
+    def stats(self, reset=False):
+        with self.lock:
+            counts = dict(self.counts); latency = {op: list(buckets) for op, buckets in self.latency.items()}; seconds = dict(self.seconds); since = self.since
+            if reset:
+                self.reset()
+        result = {**counts, 'hit_rate': counts['hits'] / max(counts['hits'] + counts['misses'], 1), 'since': since, 'elapsed': time.time() - since}
+        for op, buckets in latency.items():
+            total = sum(buckets); percentiles = dict()
+            for q in [50, 95, 99]:
+                seen = 0
+                for i, n in enumerate(buckets):
+                    seen += n
+                    if seen * 100 >= q * total:
+                        percentiles[f'p{q}'] = (2**i) / 1e6; break
+            result[f'{op}_latency'] = {'count': total, 'mean': seconds[op] / max(total, 1), **{f'p{q}': percentiles.get(f'p{q}', 0.0) for q in [50, 95, 99]}, 'buckets': {f"<{2**i}us": n for i, n in enumerate(buckets) if n}}
+        return result
+
+    def emit(self):
+        self.next_emit = time.time() + self.emit_every
+        if self.emit_file is not None and self.dirty:
+            self.dirty = False
+            # A single appended line per snapshot, so that processes sharing the file do not interleave
+            with open(self.emit_file, "a") as f:
+                f.write(json.dumps({'time': time.time(), 'pid': os.getpid(), 'path': os.path.abspath(str(self.path)), **self.stats()}) + "\n")
+
+CACHE_BACKENDS = {
+    'files': FileCacheStore,
+    'sqlite': SQLiteCacheStore,
+}
+def RegisterCacheBackend(name, store_class):
+    """Register a cache store backend, so that it can be selected by `CacheInit(backend=name)`.
+
+    Args:
+        name (str): The name of the backend.
+        store_class (type): A subclass of `CacheStore`.
+    Returns:
+        None
+    """
+    CACHE_BACKENDS[name] = store_class
+
+CACHE_STORES = dict()
+def CacheLoadConfig(path):
+    """Load the configuration of a cache path. Cache paths without a configuration file are treated as the default `files` backend.
+
+    Args:
+        path (str): The cache path.
+    Returns:
+        dict: The configuration.
+    """
+    file = pjoin(path, CACHE_CONFIG_FILE)
+    return LoadJson(file) if ExistFile(file) else {'backend': 'files'}
+
+def cache_save_config(path, config):
+    # The configuration is only written when it changes, through a temporary file and `os.replace`, so that concurrent readers never observe a partially written file
+    file = os.path.join(path, CACHE_CONFIG_FILE)
+    if os.path.isfile(file) and CacheLoadConfig(path) == config:
+        return
+    tmp = f"{file}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        SaveJson(config, tmp, indent=4); os.replace(tmp, file)
+    except BaseException:
+        cache_remove(tmp); raise
+
+def CacheGetStore(path):
+    """Get the store of a cache path. The store is created on first use and reused within the process.
+
+    Args:
+        path (str): The cache path.
+    Returns:
+        CacheStore: The store.
+    """
+    name = os.path.abspath(str(path))
+    store = CACHE_STORES.get(name, None)
+    if store is None:
+        config = CacheLoadConfig(path)
+        assert (config['backend'] in CACHE_BACKENDS), (f"Cache backend '{config['backend']}' not found! Supported backends: {list(CACHE_BACKENDS)}")
+        store = CACHE_STORES[name] = CACHE_BACKENDS[config['backend']](path, config)
+        if config.get('policy', None):
+            store.meta = CacheMeta(path, config['policy'])
+    return store
+
+def CacheCloseStore(path):
+    """Close the store of a cache path and drop it from the process.
+
+    Args:
+        path (str): The cache path.
+    Returns:
+        CacheStore: The closed store, or None if the store is not opened.
+    """
+    store = CACHE_STORES.pop(os.path.abspath(str(path)), None)
+    if store is not None:
+        if store.stats is not None:
+            store.stats.emit()
+        if store.meta is not None:
+            store.meta.close()
+        store.close()
+    return store
+
+def CacheMemoryTier(path, max_entries=None, max_bytes=None, sizeof=None):
+    """Enable (or disable) the in-process LRU memory tier of a cache path. Once enabled, `CacheGet` serves recently used entries from memory, `CacheSet` updates the memory tier and `CacheDelete` invalidates it.
+
+    The memory tier only lives in the current process.
+
+    Args:
+        path (str): The cache path.
+        max_entries (int): The maximum number of entries kept in memory.
+        max_bytes (int): The maximum approximate size in bytes of the values kept in memory.
+        sizeof: The function to estimate the size of a value in bytes. Default is the length of its pickle.
+    Returns:
+        CacheMemory: The memory tier, or None if both `max_entries` and `max_bytes` are None, in which case the memory tier is disabled.
+    """
+    store = CacheGetStore(path)
+    store.memory = CacheMemory(max_entries=max_entries, max_bytes=max_bytes, sizeof=sizeof) if (max_entries is not None or max_bytes is not None) else None
+    return store.memory
+
+def CacheMemoryStats(path):
+    """Get the hit/miss counters of the memory tier of a cache path.
+
+    Args:
+        path (str): The cache path.
+    Returns:
+        dict: The counters `hits`, `misses`, `hit_rate`, `evictions` and the current `entries` and `bytes` held in memory, or None if the memory tier is disabled.
+    """
+    memory = CacheGetStore(path).memory
+    return memory.stats() if memory is not None else None
+
+def CacheTrackStats(path, enabled=True, emit_file=None, emit_every=60.0):
+    """Enable (or disable) the statistics of a cache path in the current process. Please refer to `CacheStats`. When disabled (default), the cache operations only check whether the statistics are enabled.
+
+    Args:
+        path (str): The cache path.
+        enabled (bool): Whether to collect the statistics. Re-enabling resets the statistics.
+        emit_file (str): If provided, periodically append snapshots of the statistics to this jsonl file.
+        emit_every (float): The minimum time gap between two snapshots in seconds.
+    Returns:
+        CacheCounters: The statistics, or None if disabled.
+    """
+    store = CacheGetStore(path)
+    if store.stats is not None:
+        store.stats.emit()
+    store.stats = CacheCounters(path, emit_file=emit_file, emit_every=emit_every) if enabled else None
+    return store.stats
+
+def CacheStats(path, reset=False):
+    """Get the statistics of a cache path collected in the current process since they were enabled (please refer to `CacheTrackStats`) or last reset.
+
+    Args:
+        path (str): The cache path.
+        reset (bool): If True, reset the statistics after reading them.
+    Returns:
+        dict: The counters `hits`, `misses`, `hit_rate`, `sets`, `deletes`, `lock_retries` (failed attempts to acquire a lock held by others), `bytes_read` and `bytes_written` (bytes moved from and to the store), the latency summaries `get_latency` and `set_latency` (`count`, `mean`, `p50`, `p95`, `p99` in seconds and the histogram `buckets`), and the time window `since` and `elapsed`. None if the statistics are disabled.
+    """
+    stats = CacheGetStore(path).stats
+    return stats.stats(reset=reset) if stats is not None else None
+
+CACHE_SESSIONS = dict()
+def cache_session_begin(path):
+    # Every process using a cache path holds a shared lock on `sessions/session.lock` and owns a `sessions/<pid>` file until it closes the path cleanly
+    name = os.path.abspath(str(path))
+    if name in CACHE_SESSIONS or 'fcntl' not in globals():
+        return
+    CreateFolder(pjoin(path, "sessions"))
+    fd = os.open(pjoin(path, "sessions", "session.lock"), os.O_RDWR | os.O_CREAT, 0o666); fcntl.flock(fd, fcntl.LOCK_SH)
+    CreateFile(pjoin(path, "sessions", f"{os.getpid()}.session")); cache_remove(pjoin(path, CACHE_CLEAN_FILE))
+    CACHE_SESSIONS[name] = (path, fd, os.getpid())
+
+def cache_session_alive(file):
+    try:
+        os.kill(int(file[:-len('.session')]), 0); return True
+    except ProcessLookupError:
+        return False
+    except (ValueError, OSError):
+        return True
+
+def cache_session_exclusive(path):
+    # Take the session lock exclusively without blocking, which only succeeds if no other process is using the cache path. Returns the file descriptor holding the lock, None if sessions are not tracked on this platform, or False if the cache path is in use
+    if 'fcntl' not in globals():
+        return None
+    CreateFolder(pjoin(path, "sessions")); fd = os.open(pjoin(path, "sessions", "session.lock"), os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB); return fd
+    except OSError:
+        os.close(fd); return False
+
+def cache_session_end(path):
+    # The last process closing the path writes the clean marker, unless another session did not end cleanly
+    path, fd, pid = CACHE_SESSIONS.pop(os.path.abspath(str(path)), (path, None, None))
+    if fd is None:
+        return
+    if pid != os.getpid():
+        # The lock belongs to the open file shared with the parent process, which a forked child must neither convert nor release
+        os.close(fd); return
+    cache_remove(pjoin(path, "sessions", f"{os.getpid()}.session"))
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if not any(file.endswith('.session') for file in os.listdir(pjoin(path, "sessions"))):
+            CreateFile(pjoin(path, CACHE_CLEAN_FILE))
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def cache_after_fork():
+    # Forked children do not inherit the sessions of their parent, they begin their own sessions in `CacheInit`
+    for _, fd, _ in CACHE_SESSIONS.values():
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    CACHE_SESSIONS.clear()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=cache_after_fork)
+
+def CacheClose(path):
+    """Close a cache path in the current process. The store of the cache path is closed, and if no other process is using the cache path, it is marked as cleanly shut down, so that the next `CacheInit` can skip the integrity check. Cache paths initialized by `CacheInit` are closed automatically when the process exits normally.
+
+    Args:
+        path (str): The cache path.
+    Returns:
+        None
+    """
+    CacheCloseStore(path); cache_session_end(path)
+
+@atexit.register
+def cache_close_all():
+    for name in list(CACHE_STORES):
+        CacheCloseStore(name)
+    for name in list(CACHE_SESSIONS):
+        cache_session_end(name)
+
+def CacheInit(path, clear=True, rm=False, backend=None, key_hash=None, lock_mode=None, policy=None, codec=None, fsync=None, layout=None, memory_entries=None, memory_bytes=None, stats=None, recover=None):
     """Initialize a cache path.
-    
-    Args:  
+
+    Args:
         path (str): The cache path.
         clear (bool): Whether to clear the cache directory.
         rm (bool): If True, use `shutil` to enforce remove, otherwise `send2trash` only.
+        backend (str): The store backend of the cache path, `files` (default) saves each entry as a pair of files, `sqlite` saves all entries in a single indexed database file. If None, the backend of an existing cache path is kept. Please refer to `CACHE_BACKENDS` for all available backends.
+        key_hash (str): The function to hash keys of the cache path, `md5` (default) hashes `str(key)`, which depends on dict ordering and the string conversion of the key, `blake2b-v1` and `xxh3-v1` (requires `xxhash`) hash the canonical encoding of the key (please refer to `CanonicalKey`), which is stable and faster for large nested keys. The name is versioned, so that the hashes of an existing cache path never change. If None, the key hash of an existing cache path is kept. Please refer to `CACHE_KEY_HASHES` for all available key hashes.
+        lock_mode (str): The lock mode used when `locking` is True, `file` (default) creates a `.lock` file per locked key, `flock` uses OS-level shared/exclusive locks (`fcntl.flock`) which block efficiently and are released automatically when the holder process dies. If None, the lock mode of an existing cache path is kept.
+        policy (dict): The size limits and eviction policy of the cache path, containing any of `max_bytes` (the maximum total size of the entries), `max_entries` (the maximum number of entries), `ttl` (the default time to live of the entries in seconds), `eviction` (`lru` or `lfu`, which entries to evict first when a limit is exceeded) and `check_every` (the number of writes between two evictions, default is 64). The metadata of the entries is tracked in `meta.db` under the cache path. If None, the policy of an existing cache path is kept. If empty, the policy is removed.
+        codec (str/dict): The codec to compress new entries of the cache path, `zlib`, `zstd` (requires `zstandard`) or `lz4` (requires `lz4`). Pass a dict to configure it, containing `name`, `level` (the compression level) and `threshold` (entries smaller than `threshold` bytes are stored uncompressed). The codec is recorded in every entry, so that entries written with different codecs (or before the codec is set) can always be read. If None, the codec of an existing cache path is kept. If `none`, new entries are not compressed.
+        fsync (bool): If True, flush every committed entry to the disk before `CacheSet` returns, which survives power failures at the cost of write latency. Entries are always committed atomically regardless of `fsync`. If None, the setting of an existing cache path is kept.
+        layout (str): The folder layout of the `files` backend, `flat` (default) saves all entries directly under the cache path, `sharded` spreads them over two levels of hex-prefixed sub-folders, which is recommended for more than about 10^5 entries. If None, the layout of an existing cache path is kept. Please refer to `CacheMigrateLayout` for switching the layout of a non-empty cache path.
+        memory_entries (int): If provided, enable the in-process memory tier with at most `memory_entries` entries. Please refer to `CacheMemoryTier`.
+        memory_bytes (int): If provided, enable the in-process memory tier with at most `memory_bytes` bytes. Please refer to `CacheMemoryTier`.
+        stats (bool/dict): If provided, enable or disable the in-process statistics of the cache path. Pass a dict to enable them with the arguments of `CacheTrackStats`, e.g., `{'emit_file': "stats.jsonl", 'emit_every': 60}`. If None, the statistics of the current process are kept.
+        recover (bool): Whether to check the integrity of the cache path when `clear` is False, i.e., remove stale lock files and broken entries in a single pass over the directory. If None, the check is skipped when the cache path was cleanly shut down by all processes using it (please refer to `CacheClose`). The check is always skipped while other processes are using the cache path, since the files they are writing can not be told apart from broken entries. Notice that processes writing to the cache path without calling `CacheInit` are not tracked.
     Returns:
         None
     """
+    store = CacheCloseStore(path); memory = store.memory if store is not None else None; counters = store.stats if store is not None else None; cache_session_end(path)
+    config = CacheLoadConfig(path)
+    if 'migrating' in config and not clear:
+        CacheMigrateLayout(path, layout=config['layout']); config = CacheLoadConfig(path)
+    config.pop('migrating', None)
+    for name, value, default in [('backend', backend, 'files'), ('key_hash', key_hash, 'md5'), ('layout', layout, 'flat')]:
+        if value is not None and value != config.get(name, default):
+            if not (clear or cache_empty(path)):
+                raise Exception(f"The cache path is using {name} '{config.get(name, default)}'. Clear the cache path to switch to {name} '{value}'" + (", or use `CacheMigrateLayout`." if name == 'layout' else "."))
+            config[name] = value
+    if lock_mode is not None:
+        config['lock_mode'] = lock_mode
+    if fsync is not None:
+        config['fsync'] = bool(fsync)
+    if codec is not None:
+        config['codec'] = {'name': codec} if isinstance(codec, str) else dict(codec)
+        assert (config['codec'].get('name', 'none') in CACHE_CODECS), (f"Cache codec '{config['codec']['name']}' not found! Supported codecs: {list(CACHE_CODECS)}")
+        assert (config['codec'].get('name') not in CACHE_CODEC_PACKAGES or CACHE_CODEC_PACKAGES[config['codec']['name']][0] in globals()), (f"Cache codec '{config['codec']['name']}' requires the `{CACHE_CODEC_PACKAGES[config['codec']['name']][1]}` package!")
+        cache_decode(cache_encode(None, {**config['codec'], 'threshold': 0}))
+        if config['codec'].get('name', 'none') == 'none':
+            del config['codec']
+    if policy is not None:
+        assert all(arg in CACHE_POLICY_ARGS for arg in policy), (f"Unknown cache policy arguments! Supported arguments: {CACHE_POLICY_ARGS}")
+        assert (policy.get('eviction', 'lru') in CACHE_EVICTIONS), (f"Cache eviction '{policy['eviction']}' not found! Supported evictions: {CACHE_EVICTIONS}")
+        config['policy'] = dict(policy)
+        if not policy:
+            del config['policy']
+    assert (config['backend'] in CACHE_BACKENDS), (f"Cache backend '{config['backend']}' not found! Supported backends: {list(CACHE_BACKENDS)}")
+    assert (config.get('key_hash', 'md5') in CACHE_KEY_HASHES), (f"Cache key hash '{config['key_hash']}' not found! Supported key hashes: {list(CACHE_KEY_HASHES)}")
+    CACHE_KEY_HASHES[config.get('key_hash', 'md5')](None)
+    assert (config.get('layout', 'flat') in CACHE_LAYOUTS), (f"Cache layout '{config['layout']}' not found! Supported layouts: {CACHE_LAYOUTS}")
+    assert (config.get('layout', 'flat') == 'flat' or config['backend'] == 'files'), ("Cache layouts are only supported by the `files` backend!")
+    assert (config.get('lock_mode', 'file') in CACHE_LOCK_MODES), (f"Cache lock mode '{config['lock_mode']}' not found! Supported lock modes: {CACHE_LOCK_MODES}")
+    assert (config.get('lock_mode', 'file') != 'flock' or 'fcntl' in globals()), ("The `flock` lock mode requires `fcntl`, which is not available on this platform!")
     if clear:
         ClearFolder(path, rm=rm)
     else:
         CreateFolder(path)
-        # Check for the integrity of the cache directory
-        # 1. Remove all the lock files
-        for file in ListFiles(path):
-            if file.endswith('.lock'):
-                Delete(file, rm=True)
-        # 2. Make sure all key files have corresponding value files and vice versa
-        for file in ListFiles(path):
-            if file.endswith('.key'):
-                if not ExistFile(AsFormat(file, '.value')):
-                    Delete(file, rm=True)
-        for file in ListFiles(path):
-            if file.endswith('.value'):
-                if not ExistFile(AsFormat(file, '.key')):
-                    Delete(file, rm=True)
+    cache_save_config(path, config)
+    if 'policy' not in config:
+        for file in ["meta.db", "meta.db-wal", "meta.db-shm"]:
+            Delete(pjoin(path, file), rm=True)
+    build_meta = ('policy' in config) and not ExistFile(pjoin(path, "meta.db"))
+    if recover is None:
+        recover = not ExistFile(pjoin(path, CACHE_CLEAN_FILE))
+    if not clear:
+        store = CacheGetStore(path)
+        # The temporary files and unpaired key files of live writers are indistinguishable from garbage, so the check is skipped while other processes are using the cache path, and left to the next `CacheInit` without them
+        fd = cache_session_exclusive(path) if recover else False
+        if fd is not False:
+            try:
+                # Check for the integrity of the cache directory: remove all the lock files (`flock` locks can not be left stale) and broken entries
+                store.recover(sweep_locks=config.get('lock_mode', 'file') == 'file')
+                if ExistFolder(pjoin(path, "sessions")):
+                    for file in os.listdir(pjoin(path, "sessions")):
+                        if file.endswith('.session') and not cache_session_alive(file):
+                            cache_remove(pjoin(path, "sessions", file))
+            finally:
+                if fd is not None:
+                    os.close(fd)
+        # Build the metadata index for the entries written before the policy is set
+        if build_meta:
+            entries = list()
+            for h, _ in store.entries():
+                entries.append((h, store.size(h), None))
+                if len(entries) >= 1024:
+                    store.meta.set_many(entries); entries = list()
+            store.meta.set_many(entries); cache_evict(store)
+    if memory_entries is not None or memory_bytes is not None:
+        CacheMemoryTier(path, max_entries=memory_entries, max_bytes=memory_bytes)
+    elif memory is not None:
+        memory.clear(); CacheGetStore(path).memory = memory
+    if stats is not None:
+        CacheTrackStats(path, enabled=bool(stats), **(stats if isinstance(stats, dict) else dict()))
+    elif counters is not None:
+        CacheGetStore(path).stats = counters
+    cache_session_begin(path)
     return path
 
-def CacheLock(path, key):
+def CacheMigrateLayout(path, layout='sharded', workers=None):
+    """Convert the folder layout of an existing `files` cache path in place, e.g., from a `flat` cache to a `sharded` cache. The files are moved with `os.replace` while streaming over the folders, so that neither the entries nor the listing of the cache path are loaded into memory. An interrupted migration is resumed by the next `CacheInit` of the cache path.
+
+    The cache path must not be used by other processes during the migration.
+
+    Args:
+        path (str): The cache path.
+        layout (str): The target layout, `flat` or `sharded`. Please refer to `CacheInit`.
+        workers (int): If provided, migrate up to `workers` folders in parallel threads (only effective when migrating from the `sharded` layout).
+    Returns:
+        str: The cache path.
+    """
+    config = CacheLoadConfig(path)
+    assert (config['backend'] == 'files'), ("Cache layouts are only supported by the `files` backend!")
+    assert (layout in CACHE_LAYOUTS), (f"Cache layout '{layout}' not found! Supported layouts: {CACHE_LAYOUTS}")
+    source = config.get('migrating', config.get('layout', 'flat'))
+    if source == layout and 'migrating' not in config:
+        return path
+    store = CacheCloseStore(path); memory = store.memory if store is not None else None; counters = store.stats if store is not None else None
+    session = os.path.abspath(str(path)) in CACHE_SESSIONS; cache_session_end(path)
+    # Other processes hold the shared session lock as long as they use the cache path
+    fd = cache_session_exclusive(path)
+    if fd is False:
+        if session:
+            cache_session_begin(path)
+        raise Exception("The cache path is used by other processes. Close them before migrating the layout.")
+    try:
+        config['layout'] = layout; config['migrating'] = source
+        cache_save_config(path, config)
+        store = CacheGetStore(path); store.relayout(source, workers=workers); CacheCloseStore(path)
+        del config['migrating']
+        if layout == 'flat':
+            del config['layout']
+        cache_save_config(path, config)
+    finally:
+        if fd is not None:
+            os.close(fd)
+    if memory is not None:
+        CacheGetStore(path).memory = memory
+    if counters is not None:
+        CacheGetStore(path).stats = counters
+    if session:
+        cache_session_begin(path)
+    return path
+
+CACHE_LOCK_MODES = ['file', 'flock']
+CACHE_FLOCKS = dict()
+def cache_lock(store, h, shared=False, blocking=False):
+    if store.config.get('lock_mode', 'file') == 'flock':
+        # `flock` locks are held by the kernel and released automatically when the holder dies
+        file = os.path.join(store.path, "locks", f"{h}.lock"); ident = (file, threading.get_ident())
+        if ident in CACHE_FLOCKS:
+            return False
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        while True:
+            fd = os.open(file, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+            except OSError:
+                os.close(fd); return False
+            # The last holder removes the lock file when unlocking, so the lock is only valid if the file was not removed or recreated in the meantime
+            try:
+                if os.path.samestat(os.fstat(fd), os.stat(file)):
+                    break
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+        CACHE_FLOCKS[ident] = fd; return True
+    # `O_CREAT | O_EXCL` makes the check and the creation of the lock file a single atomic operation
+    try:
+        os.close(os.open(os.path.join(store.path, f"{h}.lock"), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)); return True
+    except FileExistsError:
+        return False
+
+def cache_wait(store, h, shared=False, retry_time=-1, retry_gap=0.0):
+    if store.config.get('lock_mode', 'file') == 'flock' and retry_time < 0:
+        if store.stats is not None:
+            if cache_lock(store, h, shared=shared):
+                return True
+            store.stats.count(lock_retries=1)
+        return cache_lock(store, h, shared=shared, blocking=True)
+    def wait_lock():
+        locked = cache_lock(store, h, shared=shared)
+        if not locked and store.stats is not None:
+            store.stats.count(lock_retries=1)
+        assert locked; return True
+    return Attempt(wait_lock, retry_time=retry_time, retry_gap=retry_gap, default=False)
+
+def cache_unlock(store, h):
+    if store.config.get('lock_mode', 'file') == 'flock':
+        file = os.path.join(store.path, "locks", f"{h}.lock"); fd = CACHE_FLOCKS.pop((file, threading.get_ident()), None)
+        if fd is not None:
+            try:
+                # Remove the lock file unless other holders share the lock, so that the lock files do not accumulate with the keys
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB); cache_remove(file)
+            except OSError:
+                pass
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN); os.close(fd)
+        return
+    if ExistFile(pjoin(store.path, f"{h}.lock")):
+        Delete(pjoin(store.path, f"{h}.lock"), rm=True)
+
+def cache_drop(store, hs, rm=True):
+    store.delete_many(hs, rm=rm)
+    if store.meta is not None:
+        store.meta.delete_many(hs)
+    if store.memory is not None:
+        for h in hs:
+            store.memory.pop(h)
+
+def cache_evict(store):
+    victims = store.meta.victims()
+    if victims:
+        cache_drop(store, victims)
+    return len(victims)
+
+def cache_record(store, entries, ttl=None):
+    # Record written `(h, size)` entries in the metadata index, return their expiration time
+    if store.meta is None:
+        assert (ttl is None), ("Setting `ttl` requires a policy on the cache path! Please refer to `CacheInit`.")
+        return None
+    ttl = store.meta.policy.get('ttl', None) if ttl is None else ttl
+    expire = (time.time() + ttl) if ttl is not None else None
+    if store.meta.set_many([(h, size, expire) for h, size in entries]):
+        try:
+            cache_evict(store)
+        except Exception:
+            pass    # The entries are already committed, and the victims are evicted again by the next eviction
+    return expire
+
+def CacheLock(path, key, shared=False):
     """Lock a cache file.
 
+    With the default `file` lock mode, a `.lock` file is created for the key. With the `flock` lock mode (please refer to `CacheInit`), an OS-level lock is taken on the key, which is released automatically if the holder process dies.
+
     Args:
         path (str): The cache path.
         key (str): The key of the cache file.
+        shared (bool): If True, take a shared (read) lock, so that multiple readers can hold the lock at the same time. Only effective with the `flock` lock mode.
     Returns:
         bool: True if the lock is successful, False if the cache file is already locked.
     """
-    h = MD5(key)
-    if ExistFile(pjoin(path, f"{h}.lock")):
-        return False
-    CreateFile(pjoin(path, f"{h}.lock"))
-    return True
+    store = CacheGetStore(path); return cache_lock(store, store.hash(key), shared=shared)
 
 
-def CacheWait(path, key, retry_time=-1, retry_gap=0.0):
+def CacheWait(path, key, retry_time=-1, retry_gap=0.0, shared=False):
     """Wait until the cache file is unlocked.
-    
+
+    With the `flock` lock mode and a negative `retry_time`, the process sleeps in the kernel until the lock is available instead of retrying.
+
     Args:
         path (str): The cache path.
         key (str): The key of the cache file.
         retry_time (int): The maximum number of retries. If `retry_time` is 0, the function will be executed only once. If `retry_time` is smaller than 0, the function will be executed indefinitely until it succeeds.
         retry_gap (float): The time gap between retries.
+        shared (bool): If True, take a shared (read) lock. Only effective with the `flock` lock mode.
     """
-    def wait_lock():
-        assert CacheLock(path, key); return True
-    return Attempt(wait_lock, retry_time=retry_time, retry_gap=retry_gap, default=False)
+    store = CacheGetStore(path); return cache_wait(store, store.hash(key), shared=shared, retry_time=retry_time, retry_gap=retry_gap)
 
 def CacheUnlock(path, key):
     """Unlock a cache file.
@@ -70,9 +1178,7 @@ def CacheUnlock(path, key):
     Returns:
         None
     """
-    h = MD5(key)
-    if ExistFile(pjoin(path, f"{h}.lock")):
-        Delete(pjoin(path, f"{h}.lock"), rm=True)
+    store = CacheGetStore(path); cache_unlock(store, store.hash(key))
 
 def CacheExist(path, key):
     """Check if the cache file exists.
@@ -83,8 +1189,8 @@ def CacheExist(path, key):
     Returns:
         bool: True if the cache file exists, False otherwise.
     """
-    h = MD5(key)
-    return ExistFile(pjoin(path, f"{h}.key"))
+    store = CacheGetStore(path)
+    return store.exist(store.hash(key))
 
 def CacheGet(path, key, default=None, load_func=LoadPickle, locking=False, retry_time=-1, retry_gap=0.0):
     """Get the content of a cache file.
@@ -94,24 +1200,50 @@ def CacheGet(path, key, default=None, load_func=LoadPickle, locking=False, retry
         key (str): The key of the cache file.
         default: The default value if the cache file does not exist.
         load_func: The function to load the cache file. Default is `LoadPickle`.
-        locking: If True, use lock to prevent multiple processes from writing the cache file at the same time.
+        locking: If True, use lock to prevent multiple processes from writing the cache file at the same time. With the `flock` lock mode, readers take shared locks and do not block each other.
         retry_time (int): The maximum number of retries to get lock of the cache. If `retry_time` is 0, the function will be executed only once. If `retry_time` is smaller than 0, the function will be executed indefinitely until it succeeds. Only effective when `locking` is True.
         retry_gap (float): The time gap between retries to get lock of the cache. Only effective when `locking` is True.
     Returns:
         Any: The content of the cache file, or `default` if the cache file does not exist.
     """
-    h = MD5(key)
-    if not CacheExist(path, key):
-        return default
+    store = CacheGetStore(path); h = store.hash(key)
+    if store.stats is None:
+        value = cache_get(store, h, load_func=load_func, locking=locking, retry_time=retry_time, retry_gap=retry_gap)
+    else:
+        start = time.perf_counter(); value = cache_get(store, h, load_func=load_func, locking=locking, retry_time=retry_time, retry_gap=retry_gap)
+        store.stats.record('get', time.perf_counter() - start, **{'misses' if value is CACHE_MISSING else 'hits': 1})
+    return default if value is CACHE_MISSING else value
+
+def cache_get(store, h, load_func=LoadPickle, locking=False, retry_time=-1, retry_gap=0.0):
+    if store.memory is not None:
+        value = store.memory.get(h)
+        if value is not CACHE_MISSING:
+            if store.meta is not None:
+                store.meta.touch(h)
+            return value
+    if not store.exist(h):
+        return CACHE_MISSING
+    expire = store.meta.expire_many([h]).get(h, None) if store.meta is not None else None
+    if expire is not None and expire <= time.time():
+        cache_drop(store, [h]); return CACHE_MISSING
     if locking:
-        lock = CacheWait(path, key, retry_time=retry_time, retry_gap=retry_gap)
+        lock = cache_wait(store, h, shared=True, retry_time=retry_time, retry_gap=retry_gap)
         if not lock:
             raise Exception("The cache file is used by another process for a long time. A deadlock may occur.")
-    value = load_func(pjoin(path, f"{h}.value"))
-    CacheUnlock(path, key)
+    try:
+        value = store.get(h, default=CACHE_MISSING, load_func=load_func)
+    finally:
+        if locking:
+            cache_unlock(store, h)
+    if value is CACHE_MISSING:
+        return CACHE_MISSING
+    if store.meta is not None:
+        store.meta.touch(h)
+    if store.memory is not None:
+        store.memory.put(h, value, expire=expire)
     return value
 
-def CacheSet(path, key, value, overwrite=True, load_func=LoadPickle, save_func=SavePickle, locking=False, retry_time=-1, retry_gap=0.0, force=False):
+def CacheSet(path, key, value, overwrite=True, load_func=LoadPickle, save_func=SavePickle, locking=False, retry_time=-1, retry_gap=0.0, force=False, ttl=None):
     """Set the content of a cache file.
 
     Args:
@@ -125,19 +1257,28 @@ def CacheSet(path, key, value, overwrite=True, load_func=LoadPickle, save_func=S
         retry_time (int): The maximum number of retries to get lock of the cache. If `retry_time` is 0, the function will be executed only once. If `retry_time` is smaller than 0, the function will be executed indefinitely until it succeeds. Only effective when `locking` is True.
         retry_gap (float): The time gap between retries to get lock of the cache. Only effective when `locking` is True.
         force (bool): If True, force to write the cache file without lock.
+        ttl (float): The time to live of the entry in seconds, which overrides the `ttl` of the policy of the cache path. Requires a policy on the cache path, please refer to `CacheInit`.
     Returns:
         Any: The final value cached for the key. If the cache file already exists and `overwrite` is False, the original value saved in the cache file will be returned, otherwise the new value will be returned.
     """
-    h = MD5(key)
-    if not overwrite and CacheExist(path, key):
-        return CacheGet(path, key, default=None, load_func=load_func, save_func=save_func, locking=locking, retry_time=retry_time, retry_gap=retry_gap)
+    store = CacheGetStore(path); h = store.hash(key)
+    if not overwrite and store.exist(h):
+        return CacheGet(path, key, default=None, load_func=load_func, locking=locking, retry_time=retry_time, retry_gap=retry_gap)
     if locking:
-        lock = CacheWait(path, key, retry_time=retry_time, retry_gap=retry_gap)
+        lock = cache_wait(store, h, retry_time=retry_time, retry_gap=retry_gap)
         if not lock and not force:
             raise Exception("The cache file is used by another process for a long time. A deadlock may occur. Try force write the cache file by setting `force` to True.")
-    save_func(key, pjoin(path, f"{h}.key"))
-    save_func(value, pjoin(path, f"{h}.value"))
-    CacheUnlock(path, key)
+    start = time.perf_counter() if store.stats is not None else None
+    try:
+        size = store.set(h, key, value, save_func=save_func)
+        expire = cache_record(store, [(h, size)], ttl=ttl)
+        if store.memory is not None:
+            store.memory.put(h, value, expire=expire)
+    finally:
+        if locking and lock:
+            cache_unlock(store, h)
+    if store.stats is not None:
+        store.stats.record('set', time.perf_counter() - start, sets=1, bytes_written=size)
     return value
 
 def CacheDelete(path, key, rm=True, locking=False, retry_time=-1, retry_gap=0.0, force=False):
@@ -154,34 +1295,238 @@ def CacheDelete(path, key, rm=True, locking=False, retry_time=-1, retry_gap=0.0,
     Returns:
         None
     """
-    h = MD5(key)
-    if not CacheExist(path, key):
+    store = CacheGetStore(path); h = store.hash(key)
+    if store.memory is not None:
+        store.memory.pop(h)
+    if not store.exist(h):
         return
     if locking:
-        lock = CacheWait(path, key, retry_time=retry_time, retry_gap=retry_gap)
+        lock = cache_wait(store, h, retry_time=retry_time, retry_gap=retry_gap)
         if not lock:
             raise Exception("The cache file is used by another process for a long time. A deadlock may occur.")
-    Delete(pjoin(path, f"{h}.key"), rm=rm)
-    Delete(pjoin(path, f"{h}.value"), rm=rm)
-    Delete(pjoin(path, f"{h}.lock"), rm=True)
+    try:
+        store.delete(h, rm=rm)
+        if store.meta is not None:
+            store.meta.delete_many([h])
+    finally:
+        if locking:
+            cache_unlock(store, h)
+    if store.stats is not None:
+        store.stats.count(deletes=1)
+
+def CacheGetMany(path, keys, default=None, load_func=LoadPickle, locking=False, retry_time=-1, retry_gap=0.0, workers=None):
+    """Get the contents of a list of cache files in one batch.
+
+    Each distinct key is hashed once, entries in the memory tier are served from memory, and the rest are loaded from the store together (e.g., in a single query for the `sqlite` backend, or on a thread pool for the `files` backend).
+
+    Args:
+        path (str): The cache path.
+        keys (list): The keys of the cache files.
+        default: The default value for keys that do not exist.
+        load_func: The function to load the cache file. Default is `LoadPickle`.
+        locking: If True, lock each key while loading it. Please refer to `CacheGet`.
+        retry_time (int): The maximum number of retries to get lock of the cache. Only effective when `locking` is True.
+        retry_gap (float): The time gap between retries to get lock of the cache. Only effective when `locking` is True.
+        workers (int): If provided, run the I/O on a thread pool with `workers` threads.
+    Returns:
+        List: The contents of the cache files in the same order as `keys`, with `default` for keys that do not exist.
+    """
+    store = CacheGetStore(path); hashes = [store.hash(key) for key in keys]; values = dict()
+    if store.memory is not None:
+        for h in hashes:
+            value = store.memory.get(h)
+            if value is not CACHE_MISSING:
+                values[h] = value
+    missing = list(dict.fromkeys(h for h in hashes if h not in values)); expires = dict()
+    if store.meta is not None:
+        for h in values:
+            store.meta.touch(h)
+        expires = store.meta.expire_many(missing); now = time.time()
+        expired = [h for h in missing if expires.get(h, now+1) <= now]
+        if expired:
+            cache_drop(store, expired); missing = [h for h in missing if h not in set(expired)]
+    if locking:
+        def get_locked(h):
+            if not cache_wait(store, h, shared=True, retry_time=retry_time, retry_gap=retry_gap):
+                raise Exception("The cache file is used by another process for a long time. A deadlock may occur.")
+            try:
+                return store.get(h, default=CACHE_MISSING, load_func=load_func)
+            finally:
+                cache_unlock(store, h)
+        loaded = cache_map(get_locked, missing, workers=workers)
+    else:
+        loaded = store.get_many(missing, default=CACHE_MISSING, load_func=load_func, workers=workers)
+    for h, value in zip(missing, loaded):
+        if value is not CACHE_MISSING:
+            values[h] = value
+            if store.meta is not None:
+                store.meta.touch(h)
+            if store.memory is not None:
+                store.memory.put(h, value, expire=expires.get(h, None))
+    if store.stats is not None:
+        hits = sum(h in values for h in hashes); store.stats.count(hits=hits, misses=len(hashes)-hits)
+    return [values.get(h, default) for h in hashes]
+
+def CacheSetMany(path, items, overwrite=True, load_func=LoadPickle, save_func=SavePickle, locking=False, retry_time=-1, retry_gap=0.0, force=False, ttl=None, workers=None):
+    """Set the contents of a list of cache files in one batch.
+
+    Args:
+        path (str): The cache path.
+        items (list): The list of `(key, value)` pairs to be saved. If a key appears multiple times, the last value is saved.
+        overwrite (bool): If True, overwrite the cache files that already exist.
+        load_func: The function to load the cache file. Default is `LoadPickle`. Only used when `overwrite` is False.
+        save_func: The function to save the cache file. Default is `SavePickle`.
+        locking: If True, lock each key while saving it. Please refer to `CacheSet`.
+        retry_time (int): The maximum number of retries to get lock of the cache. Only effective when `locking` is True.
+        retry_gap (float): The time gap between retries to get lock of the cache. Only effective when `locking` is True.
+        force (bool): If True, force to write the cache file without lock.
+        ttl (float): The time to live of the entries in seconds. Please refer to `CacheSet`.
+        workers (int): If provided, run the I/O on a thread pool with `workers` threads.
+    Returns:
+        List: The final values cached for the keys, in the same order as `items`. Please refer to `CacheSet`.
+    """
+    store = CacheGetStore(path); hashes = [store.hash(key) for key, _ in items]
+    entries = {h: (h, key, value) for h, (key, value) in zip(hashes, items)}
+    values = {h: value for h, (_, _, value) in entries.items()}
+    if not overwrite:
+        existing = CacheGetMany(path, [key for _, key, _ in entries.values()], default=CACHE_MISSING, load_func=load_func, locking=locking, retry_time=retry_time, retry_gap=retry_gap, workers=workers)
+        for h, value in zip(list(entries), existing):
+            if value is not CACHE_MISSING:
+                values[h] = value; del entries[h]
+    entries = list(entries.values())
+    if locking:
+        def set_locked(entry):
+            lock = cache_wait(store, entry[0], retry_time=retry_time, retry_gap=retry_gap)
+            if not lock and not force:
+                raise Exception("The cache file is used by another process for a long time. A deadlock may occur. Try force write the cache file by setting `force` to True.")
+            try:
+                return store.set(*entry, save_func=save_func)
+            finally:
+                if lock:
+                    cache_unlock(store, entry[0])
+        sizes = cache_map(set_locked, entries, workers=workers)
+    else:
+        sizes = store.set_many(entries, save_func=save_func, workers=workers)
+    expire = cache_record(store, [(h, size) for (h, _, _), size in zip(entries, sizes)], ttl=ttl)
+    if store.memory is not None:
+        for h, _, value in entries:
+            store.memory.put(h, value, expire=expire)
+    if store.stats is not None:
+        store.stats.count(sets=len(entries), bytes_written=sum(sizes))
+    return [values[h] for h in hashes]
+
+def CacheDeleteMany(path, keys, rm=True, locking=False, retry_time=-1, retry_gap=0.0, force=False, workers=None):
+    """Delete a list of cached keys in one batch.
+
+    Args:
+        path (str): The cache path.
+        keys (list): The keys of the cache files.
+        rm (bool): If True, use `shutil` to enforce remove, otherwise `send2trash` only.
+        locking: If True, lock each key while deleting it. Please refer to `CacheDelete`.
+        retry_time (int): The maximum number of retries to get lock of the cache. Only effective when `locking` is True.
+        retry_gap (float): The time gap between retries to get lock of the cache. Only effective when `locking` is True.
+        force (bool): If True, force to write the cache file without lock.
+        workers (int): If provided, run the I/O on a thread pool with `workers` threads.
+    Returns:
+        None
+    """
+    store = CacheGetStore(path); hashes = list(dict.fromkeys(store.hash(key) for key in keys))
+    if store.memory is not None:
+        for h in hashes:
+            store.memory.pop(h)
+    if locking:
+        def delete_locked(h):
+            if not cache_wait(store, h, retry_time=retry_time, retry_gap=retry_gap):
+                raise Exception("The cache file is used by another process for a long time. A deadlock may occur.")
+            try:
+                store.delete(h, rm=rm)
+            finally:
+                cache_unlock(store, h)
+        cache_map(delete_locked, hashes, workers=workers)
+    else:
+        store.delete_many(hashes, rm=rm, workers=workers)
+    if store.meta is not None:
+        store.meta.delete_many(hashes)
+    if store.stats is not None:
+        store.stats.count(deletes=len(hashes))
+
+def CacheEvict(path):
+    """Remove the expired entries of a cache path, and evict entries until the limits of its policy are satisfied. This also runs automatically every `check_every` writes.
 
-def CacheKeys(path, load_func=LoadPickle):
-    """Get all cached keys.
+    Args:
+        path (str): The cache path.
+    Returns:
+        int: The number of removed entries.
+    """
+    store = CacheGetStore(path)
+    return cache_evict(store) if store.meta is not None else 0
+
+class CacheLazyValue(object):
+    """A lazily loaded cache value, yielded by `CacheItems(lazy=True)`. The value is loaded from the store on the first access of `value`, and kept afterwards.
+    """
+    def __init__(self, store, h, load_func=LoadPickle, locking=False, retry_time=-1, retry_gap=0.0, default=None):
+        self.store = store; self.h = h; self.load_func = load_func; self.default = default
+        self.locking = locking; self.retry_time = retry_time; self.retry_gap = retry_gap
+        self.loaded = CACHE_MISSING
+
+    @property
+    def value(self):
+        if self.loaded is CACHE_MISSING:
+            if self.locking and not cache_wait(self.store, self.h, shared=True, retry_time=self.retry_time, retry_gap=self.retry_gap):
+                raise Exception("The cache file is used by another process for a long time. A deadlock may occur.")
+            try:
+                self.loaded = self.store.get(self.h, default=self.default, load_func=self.load_func)
+            finally:
+                if self.locking:
+                    cache_unlock(self.store, self.h)
+        return self.loaded
+
+    def __repr__(self):
+        return f"CacheLazyValue({self.h})" if self.loaded is CACHE_MISSING else f"CacheLazyValue({self.h}, {self.loaded!r})"
+
+def cache_match(key, prefix=None, predicate=None):
+    if prefix is not None:
+        if isinstance(prefix, (str, bytes)):
+            if not (isinstance(key, type(prefix)) and key.startswith(prefix)):
+                return False
+        elif not (isinstance(key, (list, tuple)) and list(key[:len(prefix)]) == list(prefix)):
+            return False
+    return predicate is None or predicate(key)
+
+def cache_entries(store, load_func=LoadPickle, ordered=False, prefix=None, predicate=None, workers=None):
+    # Stream the `(h, key)` of the matching entries, skipping expired entries in batches
+    batch = list()
+    for h, key in store.entries(load_func=load_func, ordered=ordered, workers=workers):
+        if not cache_match(key, prefix=prefix, predicate=predicate):
+            continue
+        if store.meta is None:
+            yield (h, key); continue
+        batch.append((h, key))
+        if len(batch) >= 512:
+            expires = store.meta.expire_many([h for h, _ in batch]); now = time.time()
+            yield from ((h, key) for h, key in batch if expires.get(h, now+1) > now); batch = list()
+    if batch:
+        expires = store.meta.expire_many([h for h, _ in batch]); now = time.time()
+        yield from ((h, key) for h, key in batch if expires.get(h, now+1) > now)
+
+def CacheKeys(path, load_func=LoadPickle, ordered=False, prefix=None, predicate=None, workers=None):
+    """Iterate over all cached keys. The keys are streamed from the store, so that the memory usage does not grow with the number of entries.
 
     Args:
         path (str): The cache path.
         load_func: The function to load the cache file. Default is `LoadPickle`.
+        ordered (bool): If True, iterate in the order of the key hashes, which requires listing all the entries first. Otherwise, iterate in storage order (faster).
+        prefix: If provided, only iterate over the keys starting with `prefix`. For string keys, `prefix` is a string prefix, for list/tuple keys, `prefix` is a list/tuple of leading elements.
+        predicate: If provided, only iterate over the keys for which `predicate(key)` is True.
+        workers (int): If provided, scan up to `workers` shards in parallel threads (only effective for the `sharded` layout of the `files` backend).
     Returns:
-        List[str]: A list of all keys.
+        Iterator[Any]: An iterator over the keys.
     """
-    keys = []
-    for file in ListFiles(path, ordered=True):
-        if file.endswith('.key'):
-            keys.append(load_func(pjoin(path, file)))
-    return keys
+    for _, key in cache_entries(CacheGetStore(path), load_func=load_func, ordered=ordered, prefix=prefix, predicate=predicate, workers=workers):
+        yield key
 
-def CacheItems(path, load_func=LoadPickle, locking=False, retry_time=-1, retry_gap=0.0):
-    """Get all cached key-value pairs.
+def CacheItems(path, load_func=LoadPickle, locking=False, retry_time=-1, retry_gap=0.0, ordered=False, prefix=None, predicate=None, lazy=False, workers=None):
+    """Iterate over all cached key-value pairs. The items are streamed from the store, so that the memory usage does not grow with the number of entries.
 
     Args:
         path (str): The cache path.
@@ -189,12 +1534,262 @@ def CacheItems(path, load_func=LoadPickle, locking=False, retry_time=-1, retry_g
         locking: If True, use lock to prevent multiple processes from writing the cache file at the same time.
         retry_time (int): The maximum number of retries to get lock of the cache. If `retry_time` is 0, the function will be executed only once. If `retry_time` is smaller than 0, the function will be executed indefinitely until it succeeds. Only effective when `locking` is True.
         retry_gap (float): The time gap between retries to get lock of the cache. Only effective when `locking` is True.
+        ordered (bool): If True, iterate in the order of the key hashes. Please refer to `CacheKeys`.
+        prefix: If provided, only iterate over the keys starting with `prefix`. Please refer to `CacheKeys`.
+        predicate: If provided, only iterate over the keys for which `predicate(key)` is True.
+        lazy (bool): If True, yield `CacheLazyValue` objects instead of values, which load the values only when `.value` is accessed.
+        workers (int): If provided, scan up to `workers` shards and load up to `2*workers` values in parallel threads. Please refer to `CacheKeys`.
+    Returns:
+        Iterator[Tuple(Any, Any)]: An iterator over the key-value pairs.
+    """
+    store = CacheGetStore(path)
+    entries = cache_entries(store, load_func=load_func, ordered=ordered, prefix=prefix, predicate=predicate, workers=workers)
+    if lazy:
+        for h, key in entries:
+            yield (key, CacheLazyValue(store, h, load_func=load_func, locking=locking, retry_time=retry_time, retry_gap=retry_gap))
+        return
+    load = lambda entry: (entry[1], CacheLazyValue(store, entry[0], load_func=load_func, locking=locking, retry_time=retry_time, retry_gap=retry_gap, default=CACHE_MISSING).value)
+    for key, value in cache_imap(load, entries, workers=workers):
+        if value is not CACHE_MISSING:
+            yield (key, value)  # Entries deleted during the iteration or corrupted are skipped
+
+CACHE_FLIGHTS = dict()
+CACHE_FLIGHTS_LOCK = threading.Lock()
+def cache_flight(flight):
+    # Return the future of an ongoing computation, and whether the caller should compute it
+    with CACHE_FLIGHTS_LOCK:
+        future = CACHE_FLIGHTS.get(flight, None)
+        if future is not None:
+            return future, False
+        future = CACHE_FLIGHTS[flight] = Future(); return future, True
+
+def cache_land(flight, future, value=None, error=None):
+    with CACHE_FLIGHTS_LOCK:
+        CACHE_FLIGHTS.pop(flight, None)
+    future.set_exception(error) if error is not None else future.set_result(value)
+
+def Cached(path, version=None, ignore=list(), key_func=None, locking=True, retry_time=-1, retry_gap=0.01, ttl=None):
+    """A decorator that memoizes a function (or a coroutine function) in a cache path.
+
+    The key is derived from the qualified name of the function, `version` and the arguments (bound to the signature of the function, so that positional and keyword arguments give the same key). Concurrent calls with the same missing key are computed only once: threads in the same process wait for the ongoing computation, and processes wait for the lock of the key (please refer to `CacheInit` for the `flock` lock mode, which is recommended) and then read the cached result. If the computation raises, the waiting threads receive the same exception and nothing is cached.
+
+    Example:
+        @Cached("cache/features", version="v2", ignore=['verbose'])
+        def Feature(x, verbose=False):
+            ...
+
+    Args:
+        path (str): The cache path.
+        version (str): The version of the function. Change it to invalidate the results cached by older versions.
+        ignore (list): The names of the arguments not to be included in the key, e.g., `self`.
+        key_func: If provided, the key is derived from `key_func(*args, **kwargs)` instead of the arguments.
+        locking (bool): If True, deduplicate concurrent computations across processes using the lock of the key.
+        retry_time (int): The maximum number of retries to get lock of the cache. Only effective when `locking` is True.
+        retry_gap (float): The time gap between retries to get lock of the cache. Only effective when `locking` is True.
+        ttl (float): The time to live of the cached results in seconds. Requires a policy on the cache path, please refer to `CacheSet`.
+    Returns:
+        The decorator. The decorated function has an extra attribute `cache_key`, which returns the key for the given arguments.
+    """
+    def decorator(f):
+        name = f"{f.__module__}.{f.__qualname__}"; signature = inspect.signature(f)
+        def cache_key(*args, **kwargs):
+            if key_func is not None:
+                return [name, version, key_func(*args, **kwargs)]
+            bound = signature.bind(*args, **kwargs); bound.apply_defaults()
+            return [name, version, {k: v for k, v in bound.arguments.items() if k not in ignore}]
+        def lookup(key):
+            store = CacheGetStore(path); h = store.hash(key)
+            return store, h, (os.path.abspath(str(path)), h)
+
+        if inspect.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def wrapper(*args, **kwargs):
+                key = cache_key(*args, **kwargs); value = CacheGet(path, key, default=CACHE_MISSING)
+                if value is not CACHE_MISSING:
+                    return value
+                store, h, flight = lookup(key); future, leader = cache_flight(flight)
+                if not leader:
+                    return await asyncio.wrap_future(future)
+                try:
+                    # The lock is polled instead of blocking the event loop
+                    lock = False; retry = retry_time
+                    while locking and not lock:
+                        lock = cache_lock(store, h)
+                        if not lock:
+                            if retry == 0:
+                                raise Exception("The cache file is used by another process for a long time. A deadlock may occur.")
+                            retry -= 1; await asyncio.sleep(retry_gap)
+                    try:
+                        value = CacheGet(path, key, default=CACHE_MISSING)
+                        if value is CACHE_MISSING:
+                            value = await f(*args, **kwargs); CacheSet(path, key, value, ttl=ttl)
+                    finally:
+                        if lock:
+                            cache_unlock(store, h)
+                except BaseException as e:
+                    cache_land(flight, future, error=e); raise
+                cache_land(flight, future, value=value); return value
+        else:
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                key = cache_key(*args, **kwargs); value = CacheGet(path, key, default=CACHE_MISSING)
+                if value is not CACHE_MISSING:
+                    return value
+                store, h, flight = lookup(key); future, leader = cache_flight(flight)
+                if not leader:
+                    return future.result()
+                try:
+                    lock = locking and cache_wait(store, h, retry_time=retry_time, retry_gap=retry_gap)
+                    if locking and not lock:
+                        raise Exception("The cache file is used by another process for a long time. A deadlock may occur.")
+                    try:
+                        value = CacheGet(path, key, default=CACHE_MISSING)
+                        if value is CACHE_MISSING:
+                            value = f(*args, **kwargs); CacheSet(path, key, value, ttl=ttl)
+                    finally:
+                        if lock:
+                            cache_unlock(store, h)
+                except BaseException as e:
+                    cache_land(flight, future, error=e); raise
+                cache_land(flight, future, value=value); return value
+        wrapper.cache_key = cache_key
+        return wrapper
+    return decorator
+
+# Frozen caches are single immutable files: the header, the records `<h><key><value>` (encoded by `cache_encode`) and an open-addressing hash index
+# The header is `CACHE_FROZEN_MAGIC`, the length of the json meta, the json meta, the offset and the number of slots of the index, and the number of entries
+# Each slot of the index is `(fingerprint, offset, len(h), len(key), len(value))`, where a zero fingerprint marks an empty slot
+CACHE_FROZEN_MAGIC = b"PHFROZ\x00\x01"
+CACHE_FROZEN_SLOT = struct.Struct("<QQIIQ")
+def cache_fingerprint(h):
+    return int.from_bytes(hashlib.blake2b(h.encode('utf-8'), digest_size=8).digest(), 'little') | 1
+
+def CacheFreeze(path, out, codec=None, load_func=LoadPickle):
+    """Compact a cache path into a single immutable file, which can be memory-mapped and shared by many processes with `CacheOpenFrozen`. Expired entries are skipped. The file is written to a temporary file first and then moved to `out`, so readers never observe a partial file.
+
+    Args:
+        path (str): The cache path.
+        out (str): The frozen cache file.
+        codec (str/dict): The codec to encode the values with. Please refer to `CacheInit`. If None, the codec of the cache path is used.
+        load_func: The function to load the cache file. Default is `LoadPickle`.
+    Returns:
+        str: The frozen cache file.
+    """
+    store = CacheGetStore(path); codec = store.codec if codec is None else ({'name': codec} if isinstance(codec, str) else dict(codec))
+    meta = json.dumps({'key_hash': store.config.get('key_hash', 'md5'), 'source': os.path.abspath(str(path)), 'time': time.time()}).encode('utf-8')
+    tmp = f"{out}.{os.getpid()}.tmp"; CreateFolder(os.path.dirname(os.path.abspath(out))); slots = list()
+    try:
+        with open(tmp, "wb") as f:
+            f.write(CACHE_FROZEN_MAGIC + struct.pack("<I", len(meta)) + meta + struct.pack("<QQQ", 0, 0, 0))
+            offset = f.tell()
+            for h, key in cache_entries(store, load_func=load_func, ordered=True):
+                value = store.get(h, default=CACHE_MISSING, load_func=load_func)
+                if value is CACHE_MISSING:
+                    continue
+                record = (h.encode('utf-8'), cache_encode(key, codec), cache_encode(value, codec))
+                f.write(b"".join(record)); slots.append((cache_fingerprint(h), offset) + tuple(len(part) for part in record)); offset += sum(len(part) for part in record)
+            # Keep the load factor of the index at most 1/2, so that probes are short
+            n = 1
+            while n < 2 * len(slots):
+                n *= 2
+            index = [None] * n
+            for slot in slots:
+                i = slot[0] & (n - 1)
+                while index[i] is not None:
+                    i = (i + 1) & (n - 1)
+                index[i] = slot
+            empty = CACHE_FROZEN_SLOT.pack(0, 0, 0, 0, 0)
+            f.write(b"".join(empty if slot is None else CACHE_FROZEN_SLOT.pack(*slot) for slot in index))
+            f.seek(len(CACHE_FROZEN_MAGIC) + 4 + len(meta)); f.write(struct.pack("<QQQ", offset, n, len(slots)))
+            f.flush(); os.fsync(f.fileno())
+        os.replace(tmp, out)
+    except BaseException:
+        cache_remove(tmp); raise
+    return out
+
+class CacheFrozen(object):
+    """A read-only reader of a frozen cache file created by `CacheFreeze`.
+
+    The file is memory-mapped, so all processes reading the same file share the pages of the OS page cache, and a lookup only hashes the key, probes the index and decodes the value, without any system call beyond page faults. Values are decoded on every lookup and not kept by the reader.
+    """
+    def __init__(self, file):
+        """
+        Args:
+            file (str): The frozen cache file.
+        """
+        self.file = file
+        with open(file, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        assert (self.mm[:len(CACHE_FROZEN_MAGIC)] == CACHE_FROZEN_MAGIC), (f"'{file}' is not a frozen cache file!")
+        n = len(CACHE_FROZEN_MAGIC); size, = struct.unpack_from("<I", self.mm, n)
+        self.meta = json.loads(self.mm[n+4:n+4+size].decode('utf-8'))
+        self.index, self.slots, self.count = struct.unpack_from("<QQQ", self.mm, n+4+size)
+        assert (self.meta['key_hash'] in CACHE_KEY_HASHES), (f"Cache key hash '{self.meta['key_hash']}' not found! Supported key hashes: {list(CACHE_KEY_HASHES)}")
+        self.hash = CACHE_KEY_HASHES[self.meta['key_hash']]; self.view = memoryview(self.mm)
+
+    def find(self, h):
+        fingerprint = cache_fingerprint(h); hb = h.encode('utf-8'); i = fingerprint & (self.slots - 1)
+        while True:
+            slot = CACHE_FROZEN_SLOT.unpack_from(self.mm, self.index + i * CACHE_FROZEN_SLOT.size)
+            if slot[0] == 0:
+                return None
+            if slot[0] == fingerprint and self.mm[slot[1]:slot[1]+slot[2]] == hb:
+                return slot
+            i = (i + 1) & (self.slots - 1)
+
+    def get(self, key, default=None):
+        slot = self.find(self.hash(key)) if self.slots else None
+        if slot is None:
+            return default
+        _, offset, hlen, klen, vlen = slot; start = offset + hlen + klen
+        return cache_decode_or(self.view[start:start+vlen], default)
+
+    def __contains__(self, key):
+        return self.slots > 0 and self.find(self.hash(key)) is not None
+
+    def __len__(self):
+        return self.count
+
+    def records(self):
+        for i in range(self.slots):
+            slot = CACHE_FROZEN_SLOT.unpack_from(self.mm, self.index + i * CACHE_FROZEN_SLOT.size)
+            if slot[0] != 0:
+                yield slot
+
+    def keys(self):
+        for _, offset, hlen, klen, _ in self.records():
+            yield cache_decode(self.view[offset+hlen:offset+hlen+klen])
+
+    def items(self):
+        for _, offset, hlen, klen, vlen in self.records():
+            yield (cache_decode(self.view[offset+hlen:offset+hlen+klen]), cache_decode(self.view[offset+hlen+klen:offset+hlen+klen+vlen]))
+
+    def close(self):
+        self.view.release(); self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+CACHE_FROZEN = dict()
+def CacheOpenFrozen(file):
+    """Open a frozen cache file created by `CacheFreeze`. The reader is created on first use and reused within the process, and reopened if the file is replaced (e.g., by freezing again).
+
+    Example:
+        CacheFreeze("cache/llm", "llm.frozen")
+        # In each worker process:
+        frozen = CacheOpenFrozen("llm.frozen")
+        value = frozen.get(key)
+
+    Args:
+        file (str): The frozen cache file.
     Returns:
-        List[Tuple(Any, Any)]: A list of all key-value pairs.
+        CacheFrozen: The reader.
     """
-    for file in ListFiles(path, ordered=True):
-        if file.endswith('.key'):
-            key = load_func(pjoin(path, file))
-            value = CacheGet(path, key, load_func=load_func, locking=locking, retry_time=retry_time, retry_gap=retry_gap)
-            yield (key, value)
-    return
\ No newline at end of file
+    name = os.path.abspath(str(file)); stat = os.stat(name); version = (stat.st_ino, stat.st_mtime_ns)
+    reader, opened = CACHE_FROZEN.get(name, (None, None))
+    if opened != version:
+        reader = CacheFrozen(name); CACHE_FROZEN[name] = (reader, version)
+    return reader
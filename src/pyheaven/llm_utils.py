@@ -1,6 +1,21 @@
 from .cache_utils import *
+from .misc_utils import CanonicalKey, BLAKE2B
+from collections import deque
 import openai
+import asyncio
+import concurrent.futures
+import email.utils
+import functools
+import hashlib
+import json
+import math
+import random
+import re
+import struct
+import threading
 import time
+import weakref
+Import("fcntl",globals())
 
 DEFAULT_LLM_CONFIG_PATH = pjoin(PYHEAVEN_PATH, "llm_config.json")
 def LoadDefaultLLMConfig():
@@ -20,10 +35,10 @@ def LoadDefaultLLMConfig():
 def LLMInit(path, config=None, clear=True, rm=False,
         openai_api_key=None, openai_api_organization=None,
         aiml_api_key=None, aiml_base_url=None,
-        vertex_project_id=None, vertex_location=None, vertex_api_key_refresh_time=None,
+        vertex_project_id=None, vertex_location=None, vertex_api_key_refresh_time=None, vertex_token_command=None,
         deepseek_api_key=None, deepseek_base_url=None,
         siliconflow_api_key=None, siliconflow_base_url=None,
-        other_platforms=dict()
+        other_platforms=dict(), rate_limits=dict(), semantic_cache=None, telemetry=None, routes=dict()
     ):
     """Initialize the working directory of an LLM instance.
     
@@ -41,7 +56,8 @@ def LLMInit(path, config=None, clear=True, rm=False,
         
         vertex_project_id (str): The Google Cloud Vertex project ID. If provided, will overwrite the corresponding value in `config`.
         vertex_location (str): The Google Cloud Vertex location. If provided, will overwrite the corresponding value in `config`.
-        vertex_api_key_refresh_time (int): The time gap between refreshing the Google Cloud Vertex API key.
+        vertex_api_key_refresh_time (int): The lifetime of the Google Cloud Vertex API key (access token), which is renewed in the background shortly before it expires. Please refer to `LLMTokenRefresher`.
+        vertex_token_command (str): The shell command printing the Google Cloud Vertex access token, default is `gcloud auth application-default print-access-token`. If provided, will overwrite the corresponding value in `config`.
         
         deepseek_api_key (str): The DeepSeek API key. If provided, will overwrite the corresponding value in `config`.
         deepseek_base_url (str): The DeepSeek API base URL. If provided, will overwrite the corresponding value in `config`.
@@ -50,6 +66,10 @@ def LLMInit(path, config=None, clear=True, rm=False,
         siliconflow_base_url (str): The Silicon Flow API base URL. If provided, will overwrite the corresponding value in `config`.
         
         other_platforms (dict): The configuration of other platforms, each platform should be a key-value pair, with the key being the platform name and the value being a dictionary containing the configuration of the platform, mainly including `api_key`, `base_url`, `model`, `temperature`, `seed`. Notice that the value passed in will overwrite the corresponding value in `config`, but will be overwritten by the corresponding value in the above arguments.
+        rate_limits (dict): The rate limits of the backends, each is a key-value pair, with the key being the backend name and the value being a dictionary containing `rpm` (requests per minute) and/or `tpm` (tokens per minute). The limits are saved as `rate_limit` of the backends in `config`, and shared by all processes using the LLM path. Please refer to `LLMGetRateLimiter`.
+        semantic_cache (dict): If provided, enable the semantic cache, which answers prompts that only differ from a cached prompt after normalization (or, optionally, are similar enough). It is saved as `semantic_cache` in `config`. Please refer to `LLMSemanticCache` for the options, e.g., `{"normalizers": ["timestamps", "uuids", "whitespace"], "index": "minhash", "threshold": 0.9}`.
+        telemetry (bool): Whether to log the tokens, latency, retries and cache outcome of every query to `<path>/telemetry.jsonl`. It is saved as `telemetry` in `config`. If None, it is enabled unless `config` already contains `telemetry`. Please refer to `LLMTelemetry` and `LLMTelemetryStats`.
+        routes (dict): The routes of backends, each is a key-value pair, with the key being the route name and the value being a dictionary containing `backends` (a list of backends tried in order, or a dict of backends and their weights), and optionally `hedge` (True or a percentile such as `"p95"` to hedge after that percentile of the recent latencies of the backend, or a fixed delay in seconds), `hedge_delay` (the delay before enough latencies are observed, default is no hedging), `temperature` and `seed` (default to those of the first backend). The routes are saved as `routes` in `config`, and a route name can be used as a backend (including `default_backend`). Please refer to `LLMQuery`.
     Returns:
         None
     """
@@ -101,6 +121,8 @@ def LLMInit(path, config=None, clear=True, rm=False,
         config['vertex-api']['location'] = vertex_location
     if vertex_api_key_refresh_time is not None:
         config['vertex-api']['api_key_refresh_time'] = vertex_api_key_refresh_time
+    if vertex_token_command is not None:
+        config['vertex-api']['token_command'] = vertex_token_command
     
     if 'deepseek-api' not in config:
         config['deepseek-api'] = {
@@ -130,6 +152,26 @@ def LLMInit(path, config=None, clear=True, rm=False,
     
     if 'default_backend' not in config:
         config['default_backend'] = "deepseek-api"
+
+    if 'cache_key' not in config:
+        # New instances key the cache by prompt fingerprints, existing instances without `cache_key` keep the full identifiers
+        config['cache_key'] = "fingerprint-v1"
+
+    for backend, rate_limit in rate_limits.items():
+        if backend not in config:
+            raise ValueError(f"Unknown backend '{backend}' in `rate_limits`!")
+        config[backend]['rate_limit'] = dict(rate_limit)
+
+    if semantic_cache is not None:
+        config['semantic_cache'] = dict(semantic_cache)
+
+    if routes:
+        config['routes'] = {**config.get('routes', dict()), **routes}
+
+    if telemetry is not None:
+        config['telemetry'] = bool(telemetry)
+    elif 'telemetry' not in config:
+        config['telemetry'] = True
     
     if not ExistFile(pjoin(path, "config.json")):
         SaveJson(config, pjoin(path, "config.json"), indent=4)
@@ -142,14 +184,15 @@ def LLMSimpleQueryAPI(instance, messages, functions=list(), model=None, temperat
     
     Args:
         instance (openai.OpenAI): The LLM instance.
-        messages (list): The list of messages to query.
+        messages (list): The list of messages to query, or an `LLMPrompt`.
         functions (list): The list of functions to query.
         model (str): The model to be used.
         temperature (float): The temperature to be used.
         seed (int): The seed to be used.
     Returns:
-        str: The response of the LLM instance.
+        dict: The response message of the LLM instance, containing `role`, `content`, `function_call`, `tool_calls` and the token `usage`.
     """
+    messages = list(messages)
     if functions:
         response = instance.chat.completions.create(
             model = model,
@@ -157,64 +200,1298 @@ def LLMSimpleQueryAPI(instance, messages, functions=list(), model=None, temperat
             functions = functions,
             temperature = temperature,
             seed = seed
-        ).choices[0].message
+        )
     else:
         response = instance.chat.completions.create(
             model = model,
             messages = messages,
             temperature = temperature,
             seed = seed
-        ).choices[0].message
-    response = {'role':response.role, 'content':response.content, 'function_call':response.function_call, 'tool_calls':response.tool_calls}
+        )
+    message = response.choices[0].message; usage = getattr(response, 'usage', None)
+    response = {'role':message.role, 'content':message.content, 'function_call':message.function_call, 'tool_calls':message.tool_calls,
+        'usage':{'prompt_tokens':usage.prompt_tokens, 'completion_tokens':usage.completion_tokens, 'total_tokens':usage.total_tokens} if usage is not None else None}
     return response
 
-def LLMQuery(path, messages, functions=list(), backend=None, model=None, temperature=None, seed=None, retry_time=3, retry_gap=0.1):
-    """Query an LLM instance. Support config, caching and retrying.
-    
-    Currently only OpenAI API is supported (aiml and vertex are accessed through `base_url`). You need to set the OpenAI API key and organization before using this function.
-    
+async def LLMSimpleQueryAPIAsync(instance, messages, functions=list(), model=None, temperature=None, seed=None):
+    """Query an LLM instance asynchronously. This is the async version of `LLMSimpleQueryAPI`.
+
     Args:
-        path (str): The LLM instance path.
-        messages (list/str): The list of messages to query. If passed in as a string, it will be converted to a simple message: [{'role':'user', 'content': '<messages>'}].
+        instance (openai.AsyncOpenAI): The async LLM instance.
+        messages (list): The list of messages to query, or an `LLMPrompt`.
         functions (list): The list of functions to query.
         model (str): The model to be used.
         temperature (float): The temperature to be used.
         seed (int): The seed to be used.
-        retry_time (int): The maximum number of retries. If `retry_time` is 0, the function will be executed only once. If `retry_time` is smaller than 0, the function will be executed indefinitely until it succeeds.
-        retry_gap (float): The time gap between retries.
     Returns:
-        str: The response of the LLM instance.
+        dict: The response message of the LLM instance. Please refer to `LLMSimpleQueryAPI`.
     """
-    config = LoadJson(pjoin(path, "config.json"))
-    if backend is None:
-        backend = config["default-api"]
+    messages = list(messages)
+    if functions:
+        response = (await instance.chat.completions.create(
+            model = model,
+            messages = messages,
+            functions = functions,
+            temperature = temperature,
+            seed = seed
+        ))
+    else:
+        response = (await instance.chat.completions.create(
+            model = model,
+            messages = messages,
+            temperature = temperature,
+            seed = seed
+        ))
+    message = response.choices[0].message; usage = getattr(response, 'usage', None)
+    response = {'role':message.role, 'content':message.content, 'function_call':message.function_call, 'tool_calls':message.tool_calls,
+        'usage':{'prompt_tokens':usage.prompt_tokens, 'completion_tokens':usage.completion_tokens, 'total_tokens':usage.total_tokens} if usage is not None else None}
+    return response
+
+def LLMStreamQueryAPI(instance, messages, functions=list(), model=None, temperature=None, seed=None):
+    """Query an LLM instance with a streaming response. This is the streaming version of `LLMSimpleQueryAPI`.
+
+    Example:
+        stream = LLMStreamQueryAPI(instance, messages, model=model)
+        response = yield from stream   # Forward the deltas, and get the assembled response
+
+    Args:
+        instance (openai.OpenAI): The LLM instance.
+        messages (list): The list of messages to query, or an `LLMPrompt`.
+        functions (list): The list of functions to query.
+        model (str): The model to be used.
+        temperature (float): The temperature to be used.
+        seed (int): The seed to be used.
+    Returns:
+        Generator[str]: A generator yielding the content deltas as they arrive, whose return value (`StopIteration.value`) is the assembled response message. Please refer to `LLMSimpleQueryAPI`. The token `usage` is not reported when streaming.
+    """
+    messages = list(messages)
+    if functions:
+        completion = instance.chat.completions.create(model=model, messages=messages, functions=functions, temperature=temperature, seed=seed, stream=True)
+    else:
+        completion = instance.chat.completions.create(model=model, messages=messages, temperature=temperature, seed=seed, stream=True)
+    role = 'assistant'; content = list(); function_call = None; tool_calls = dict()
+    try:
+        for chunk in completion:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta; role = delta.role or role
+            if delta.content:
+                content.append(delta.content); yield delta.content
+            if delta.function_call is not None:
+                function_call = function_call or {'name': "", 'arguments': ""}
+                function_call['name'] += delta.function_call.name or ""; function_call['arguments'] += delta.function_call.arguments or ""
+            for call in (delta.tool_calls or list()):
+                entry = tool_calls.setdefault(call.index, {'id': None, 'type': 'function', 'function': {'name': "", 'arguments': ""}})
+                entry['id'] = call.id or entry['id']
+                if call.function is not None:
+                    entry['function']['name'] += call.function.name or ""; entry['function']['arguments'] += call.function.arguments or ""
+    finally:
+        completion.close()
+    return {'role':role, 'content':"".join(content) if content or (function_call is None and not tool_calls) else None, 'function_call':function_call, 'tool_calls':[tool_calls[index] for index in sorted(tool_calls)] or None, 'usage':None}
+
+LLM_CONFIGS = dict()
+def LLMLoadConfig(path):
+    """Load the config of an LLM instance. The parsed config is cached within the process, and reloaded only when `config.json` is modified (i.e., its mtime, size or inode changes).
+
+    Args:
+        path (str): The LLM instance path.
+    Returns:
+        dict: The config. The returned dict is shared within the process and should not be modified in place.
+    """
+    file = os.path.abspath(os.path.join(path, "config.json")); stat = os.stat(file); version = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    config, loaded = LLM_CONFIGS.get(file, (None, None))
+    if loaded != version:
+        config = LoadJson(file); LLM_CONFIGS[file] = (config, version)
+    return config
+
+LLM_VERTEX_TOKEN_COMMAND = "gcloud auth application-default print-access-token"
+class LLMTokenRefresher(object):
+    """Keeps the short-lived access token of a backend (e.g., `vertex-api`) fresh in the background, shared by all processes using the same LLM instance path.
+
+    The token lives in `<path>/tokens/<backend>.json` together with its expiry, and is replaced atomically (written to a temporary file and moved into place with `os.replace`), so that requests read the current token without any lock and never observe a partially written one. A daemon thread renews the token shortly before it expires by running the token command, under an exclusive `fcntl.flock`, so that only one process runs the command at a time and the others pick up the new token from the store. Requests only run the command themselves when there is no valid token at all, e.g., on first use.
+
+    The token command prints the token, or a JSON object containing `access_token` (or `token`) and `expires_in` (in seconds). Tokens without `expires_in` are assumed to expire after `lifetime` seconds.
+
+    If a background renewal fails, it is retried after 10 seconds, and the exception is kept as `last_error` until a renewal succeeds.
+    """
+    def __init__(self, path, backend, command, lifetime=3600):
+        """
+        Args:
+            path (str): The LLM instance path.
+            backend (str): The backend.
+            command (str): The shell command printing the token.
+            lifetime (float): The lifetime of tokens whose expiry is not reported by the command.
+        """
+        self.file = pjoin(path, "tokens", f"{backend}.json"); self.backend = backend; self.command = command; self.lifetime = lifetime
+        self.cached = (None, None); self.lock = threading.Lock(); self.stopped = threading.Event(); self.thread = None; self.pid = None; self.last_error = None
+
+    def load(self):
+        # Lock-free read of the store, which is parsed again only when the file is replaced
+        try:
+            stat = os.stat(self.file)
+        except FileNotFoundError:
+            return None
+        version = (stat.st_mtime_ns, stat.st_ino); cached = self.cached
+        if cached[0] != version:
+            try:
+                with open(self.file, "r", encoding="utf-8") as f:
+                    cached = self.cached = (version, json.load(f))
+            except (OSError, ValueError):
+                return None
+        return cached[1]
+
+    def token(self):
+        """Get the current token. The background refresher is started on first use.
+
+        Returns:
+            str: The token.
+        """
+        self.start(); state = self.load()
+        if state is None or state['expires'] <= time.time():
+            state = self.refresh()
+        return state['token']
+
+    def refresh(self, force=False):
+        """Renew the token by running the token command, unless the token in the store is not due for renewal (e.g., it is just renewed by another process).
+
+        Args:
+            force (bool): If True, always run the token command.
+        Returns:
+            dict: The state of the store, containing the `token`, the time it `expires` and the time it is due for renewal (`renew`).
+        """
+        CreateFolder(os.path.dirname(self.file))
+        with self.lock, open(self.file + ".lock", "a") as lock:
+            if 'fcntl' in globals():
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            state = self.load()
+            if not force and state is not None and state['renew'] > time.time():
+                return state
+            p = CMD(self.command, stdout=PIPE, stderr=PIPE); out, err = p.communicate()
+            assert (p.returncode == 0), (f"Failed to get the access token of {self.backend}: {err.decode('utf-8', 'replace').strip()}")
+            out = out.decode("utf-8").strip()
+            try:
+                data = json.loads(out)
+            except ValueError:
+                data = None
+            token, expires_in = (data.get('access_token', data.get('token')), float(data.get('expires_in', self.lifetime))) if isinstance(data, dict) else (out, float(self.lifetime))
+            # Renew a token when a quarter of its lifetime (at most 5 minutes) is left, so that requests never wait for the command
+            now = time.time(); state = {'token': token, 'expires': now + expires_in, 'renew': now + expires_in - min(300.0, expires_in / 4)}
+            tmp = f"{self.file}.{os.getpid()}-{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp, self.file)
+            return state
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                delay = self.refresh()['renew'] - time.time(); self.last_error = None
+            except Exception as e:
+                # Keep the failure for inspection and retry soon, requests fall back to running the command themselves once the token expires
+                self.last_error = e; delay = 10.0
+            self.stopped.wait(max(1.0, delay))
+
+    def start(self):
+        """Start the background refresher if it is not running in this process (threads do not survive forks)."""
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.stopped = threading.Event(); self.thread = threading.Thread(target=self.run, name=f"pyheaven-token-{self.backend}", daemon=True)
+                    self.thread.start(); self.pid = os.getpid()
+
+    def stop(self):
+        """Stop the background refresher."""
+        self.stopped.set(); self.pid = None
+
+LLM_TOKEN_REFRESHERS = dict()
+LLM_TOKEN_REFRESHERS_LOCK = threading.Lock()
+def LLMGetTokenRefresher(path, backend="vertex-api"):
+    """Get the token refresher of a backend of an LLM instance, which is configured by `token_command` (default to `gcloud auth application-default print-access-token` for `vertex-api`) and `api_key_refresh_time` (the lifetime of the tokens) of the backend in `config.json`. Please refer to `LLMTokenRefresher`.
+
+    Args:
+        path (str): The LLM instance path.
+        backend (str): The backend.
+    Returns:
+        LLMTokenRefresher: The token refresher, reused within the process until its config changes.
+    """
+    backend_config = LLMLoadConfig(path)[backend]; command = backend_config.get('token_command', LLM_VERTEX_TOKEN_COMMAND if backend == "vertex-api" else None); lifetime = backend_config.get('api_key_refresh_time', 3600)
+    assert (command is not None), (f"No `token_command` is configured for {backend}!")
+    key = (os.path.abspath(path), backend)
+    with LLM_TOKEN_REFRESHERS_LOCK:
+        refresher = LLM_TOKEN_REFRESHERS.get(key, None)
+        if refresher is None or (refresher.command, refresher.lifetime) != (command, lifetime):
+            if refresher is not None:
+                refresher.stop()
+            refresher = LLM_TOKEN_REFRESHERS[key] = LLMTokenRefresher(path, backend, command, lifetime=lifetime)
+    return refresher
+
+LLM_BACKENDS = dict()
+def llm_backend(path, backend=None):
+    # Resolve the backend configuration and the arguments of the OpenAI client, cached by (path, backend) until the config changes
+    config = LLMLoadConfig(path); backend = llm_backend_name(path, backend)
+    key = (os.path.abspath(path), backend); cached = LLM_BACKENDS.get(key, None)
+    # Short-lived tokens are read from the store of the token refresher, which is cheap and never blocks on the token command unless the token has expired
+    token = LLMGetTokenRefresher(path, backend).token() if backend == "vertex-api" or 'token_command' in config.get(backend, dict()) else None
+    if cached is not None and cached[0] is config and (token is None or cached[2]['api_key'] == token):
+        return cached[1], cached[2]
     if backend == "openai-api":
         base_url = None
     elif backend in ["aiml-api", "deepseek-api"]:
         base_url = config[backend]["base_url"]
     elif backend == "vertex-api":
         base_url = f"https://{config[backend]['location']}-aiplatform.googleapis.com/v1beta1/projects/{config[backend]['project_id']}/locations/{config[backend]['location']}/endpoints/openapi"
-        if ('api_key' not in config[backend]) or ('api_key_time' not in config[backend]) or (time.time()-config[backend]['api_key_time'] >= config[backend]['api_key_refresh_time']):
-            p = CMD(f"gcloud auth application-default print-access-token", stdout=PIPE)
-            api_key, err = p.communicate()
-            assert (err is None), f"Failed to get Google Cloud Vertex API key: {err}"
-            config[backend]['api_key'] = api_key.decode("utf-8").strip()
-            config[backend]['api_key_time'] = int(time.time())
-            SaveJson(config, pjoin(path, "config.json"), indent=4)
+    elif backend in config and "base_url" in config[backend]:
+        base_url = config[backend]["base_url"]
     else:
         raise NotImplementedError(f"Backend {backend} is not supported.")
-    instance = openai.OpenAI(api_key=config[backend]["api_key"], base_url=base_url)
-    if model is None: model = config[backend]["model"]
-    if temperature is None: temperature = config[backend]["temperature"]
-    if seed is None: seed = config[backend]["seed"]
+    # Retries are handled by `LLMQuery` with the rate limiter and backoff, so the SDK does not retry unless `max_retries` is set for the backend
+    client_args = {'api_key': token if token is not None else config[backend]["api_key"], 'base_url': base_url, 'max_retries': config[backend].get('max_retries', 0)}
+    LLM_BACKENDS[key] = (config, config[backend], client_args)
+    return config[backend], client_args
+
+LLM_CLIENTS = dict()
+LLM_CLIENTS_LOCK = threading.Lock()
+def LLMClient(path, backend=None):
+    """Get the OpenAI client of a backend of an LLM instance. The client (and its HTTP connection pool) is created on first use and reused within the process, until the config of the backend changes (e.g., a new API key).
+
+    The client does not retry failed requests by itself, since `LLMQuery` retries through the rate limiter and backoff of the backend. Set `max_retries` of the backend in `config.json` to enable the retries of the SDK.
+
+    Args:
+        path (str): The LLM instance path.
+        backend (str): The backend. If None, the default backend of the config is used.
+    Returns:
+        openai.OpenAI: The client.
+    """
+    backend = llm_backend_name(path, backend); _, client_args = llm_backend(path, backend); key = (os.path.abspath(path), backend)
+    with LLM_CLIENTS_LOCK:
+        client, args, pid = LLM_CLIENTS.get(key, (None, None, None))
+        if args != client_args or pid != os.getpid():
+            # Connection pools can not be shared with forked processes
+            client = openai.OpenAI(**client_args); LLM_CLIENTS[key] = (client, client_args, os.getpid())
+    return client
+
+LLM_ASYNC_CLIENTS = weakref.WeakKeyDictionary(); LLM_ASYNC_CLOSING = set()
+async def llm_async_clients(clients):
+    # Registered as an async generator of the event loop, whose finalization by `asyncio.run` (`loop.shutdown_asyncgens`) closes the clients of the loop and their connection pools
+    try:
+        yield
+    finally:
+        for client, _ in list(clients.values()):
+            await client.close()
+        clients.clear()
+
+def LLMClientAsync(path, backend=None):
+    """Get the async OpenAI client of a backend of an LLM instance for the running event loop. Please refer to `LLMClient`. Since async connection pools are bound to an event loop, clients are reused per event loop, and closed when the event loop is shut down by `asyncio.run` (or `loop.shutdown_asyncgens`).
+
+    Args:
+        path (str): The LLM instance path.
+        backend (str): The backend. If None, the default backend of the config is used.
+    Returns:
+        openai.AsyncOpenAI: The async client.
+    """
+    backend = llm_backend_name(path, backend); _, client_args = llm_backend(path, backend); key = (os.path.abspath(path), backend)
+    loop = asyncio.get_running_loop(); clients, _ = LLM_ASYNC_CLIENTS.get(loop, (None, None))
+    if clients is None:
+        clients = dict(); finalizer = llm_async_clients(clients); LLM_ASYNC_CLIENTS[loop] = (clients, finalizer)
+        asyncio.ensure_future(finalizer.__anext__())
+    client, args = clients.get(key, (None, None))
+    if args != client_args:
+        if client is not None:
+            # The replaced client is closed in the background, since requests may still be using it
+            task = asyncio.ensure_future(client.close()); LLM_ASYNC_CLOSING.add(task); task.add_done_callback(LLM_ASYNC_CLOSING.discard)
+        client = openai.AsyncOpenAI(**client_args); clients[key] = (client, client_args)
+    return client
+
+LLM_FINGERPRINT_ROOT = hashlib.blake2b(b"pyheaven-llm-fingerprint-v1", digest_size=16).digest()
+LLM_MESSAGE_DIGESTS = dict(); LLM_MESSAGE_DIGESTS_SIZE = 4096
+def llm_message_digest(message):
+    # Plain text messages are memoized by `(role, content)`, whose lookup is cheap since python caches the hashes of strings, so shared system prompts and earlier turns are not encoded again
+    memo = (message['role'], message['content']) if type(message) is dict and len(message) == 2 and type(message.get('role')) is str and type(message.get('content')) is str else None
+    digest = LLM_MESSAGE_DIGESTS.get(memo, None) if memo is not None else None
+    if digest is None:
+        digest = hashlib.blake2b(CanonicalKey(message).encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+        if memo is not None:
+            if len(LLM_MESSAGE_DIGESTS) >= LLM_MESSAGE_DIGESTS_SIZE:
+                try: LLM_MESSAGE_DIGESTS.pop(next(iter(LLM_MESSAGE_DIGESTS), None), None)
+                except RuntimeError: pass
+            LLM_MESSAGE_DIGESTS[memo] = digest
+    return digest
+def LLMFingerprint(messages, prefix=None):
+    """Compute the incremental fingerprints of a conversation. Each message is hashed once (over its canonical encoding, please refer to `CanonicalKey`), and the hashes are chained, so that the fingerprint of a conversation only depends on the fingerprint of its prefix and the new messages.
+
+    Example:
+        chain = LLMFingerprint(messages)
+        chain = LLMFingerprint([reply, follow_up], prefix=chain)   # Same as `LLMFingerprint(messages + [reply, follow_up])`, without hashing `messages` again
+
+    Args:
+        messages (list/str): The list of messages. If passed in as a string, it will be converted to a simple message: [{'role':'user', 'content': '<messages>'}].
+        prefix (list): The fingerprints of the preceding messages, as returned by `LLMFingerprint`.
+    Returns:
+        list: The 16-byte fingerprints of all the prefixes of the conversation, i.e., the `i`-th fingerprint identifies the first `i+1` messages.
+    """
     if isinstance(messages, str): messages = [{'role':'user', 'content': messages}]
-    identifier = [model, f"T={(temperature):05.3f}", seed, messages, functions]
+    chain = list(prefix) if prefix else list(); last = chain[-1] if chain else LLM_FINGERPRINT_ROOT
+    for message in messages:
+        last = hashlib.blake2b(last + llm_message_digest(message), digest_size=16).digest(); chain.append(last)
+    return chain
+
+def llm_fingerprint_key(model, temperature, seed, functions, chain):
+    # A small header and the fingerprints of the conversation, where the prefixes are truncated to 8 bytes each for prefix lookups
+    return {'v': 1, 'model': model, 'T': f"{temperature:05.3f}", 'seed': seed, 'functions': BLAKE2B(functions) if functions else None,
+        'prompt': chain[-1].hex() if chain else None, 'prefixes': b"".join(fingerprint[:8] for fingerprint in chain)}
+
+class LLMTemplate(object):
+    """A conversation template, i.e., the leading messages shared by many prompts, such as a long system prompt and few-shot examples.
+
+    The template is hashed once (please refer to `LLMFingerprint`) and its messages are stored once under `<path>/templates`, keyed by `id`. Prompts built by `prompt` only hash and store their own suffix: with fingerprint keys (the default of `LLMInit`), the key of a prompt is computed from the fingerprints of the template and the suffix, and is the same as the key of the assembled messages; with the full identifiers, the key contains the `id` of the template and the suffix instead of all the messages.
+
+    Example:
+        template = LLMTemplate(path, [system_prompt] + few_shot_examples)
+        LLMQuery(path, template.prompt(question))
+        list(LLMCacheLookupPrefix(path, None, prefix=template.chain))   # All the cached prompts of the template
+    """
+    def __init__(self, path, messages):
+        """
+        Args:
+            path (str): The LLM instance path.
+            messages (list/str): The leading messages. If passed in as a string, it will be converted to a simple message: [{'role':'system', 'content': '<messages>'}].
+        """
+        if isinstance(messages, str): messages = [{'role':'system', 'content': messages}]
+        self.messages = list(messages); self.chain = LLMFingerprint(self.messages); self.id = self.chain[-1].hex() if self.chain else LLM_FINGERPRINT_ROOT.hex()
+        key = (os.path.abspath(path), self.id)
+        if key not in LLM_TEMPLATES:
+            templates = pjoin(path, "templates")
+            if not ExistFile(pjoin(templates, CACHE_CONFIG_FILE)):
+                CacheInit(templates, clear=False, key_hash='blake2b-v1')
+            if not CacheExist(templates, self.id):
+                CacheSet(templates, self.id, self.messages)
+            LLM_TEMPLATES.add(key)
+
+    def prompt(self, suffix):
+        """Build a prompt from the template and a suffix, without copying or hashing the messages of the template.
+
+        Args:
+            suffix (list/str): The messages following the template. If passed in as a string, it will be converted to a simple message: [{'role':'user', 'content': '<suffix>'}].
+        Returns:
+            LLMPrompt: The prompt, which can be passed to `LLMQuery` (and the other query functions) as `messages`.
+        """
+        return LLMPrompt(self, suffix)
+
+class LLMPrompt(object):
+    """A prompt made of an `LLMTemplate` and a suffix. The messages are only assembled when the prompt is sent (i.e., on a cache miss), and behave as a read-only list of messages."""
+    def __init__(self, template, suffix):
+        """
+        Args:
+            template (LLMTemplate): The template.
+            suffix (list/str): The messages following the template. Please refer to `LLMTemplate.prompt`.
+        """
+        if isinstance(suffix, str): suffix = [{'role':'user', 'content': suffix}]
+        self.template = template; self.suffix = list(suffix); self.assembled = None
+
+    @property
+    def messages(self):
+        if self.assembled is None:
+            self.assembled = self.template.messages + self.suffix
+        return self.assembled
+
+    def fingerprint(self):
+        """Compute the fingerprints of the prompt, only hashing the suffix. Please refer to `LLMFingerprint`."""
+        return LLMFingerprint(self.suffix, prefix=self.template.chain)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __len__(self):
+        return len(self.template.messages) + len(self.suffix)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+LLM_TEMPLATES = set()
+def LLMLoadTemplate(path, template_id):
+    """Load a template stored by `LLMTemplate`, e.g., to reassemble the prompts of cache keys containing the `id` of a template.
+
+    Args:
+        path (str): The LLM instance path.
+        template_id (str): The `id` of the template.
+    Returns:
+        LLMTemplate: The template, or None if it is not found.
+    """
+    messages = CacheGet(pjoin(path, "templates"), template_id, default=None) if ExistFile(pjoin(path, "templates", CACHE_CONFIG_FILE)) else None
+    return LLMTemplate(path, messages) if messages is not None else None
+
+def llm_identifier(path, backend_config, messages, functions=list(), model=None, temperature=None, seed=None):
+    if model is None: model = backend_config["model"]
+    if temperature is None: temperature = backend_config["temperature"]
+    if seed is None: seed = backend_config["seed"]
+    if isinstance(messages, str): messages = [{'role':'user', 'content': messages}]
+    if LLMLoadConfig(path).get("cache_key", "identifier") == "fingerprint-v1":
+        return messages, model, temperature, seed, llm_fingerprint_key(model, temperature, seed, functions, messages.fingerprint() if isinstance(messages, LLMPrompt) else LLMFingerprint(messages))
+    if isinstance(messages, LLMPrompt):
+        return messages, model, temperature, seed, [model, f"T={(temperature):05.3f}", seed, {'template': messages.template.id}, messages.suffix, functions]
+    return messages, model, temperature, seed, [model, f"T={(temperature):05.3f}", seed, messages, functions]
+
+LLM_NORMALIZERS = {
+    'whitespace': lambda text: re.sub(r"\s+", " ", text).strip(),
+    'timestamps': lambda text: re.sub(r"\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?|\b\d{1,2}:\d{2}:\d{2}(?:\.\d+)?\b", "<TIME>", text),
+    'uuids': lambda text: re.sub(r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b", "<UUID>", text),
+    'hex': lambda text: re.sub(r"\b(?=[0-9a-fA-F]*\d)[0-9a-fA-F]{16,}\b", "<HEX>", text),
+    'numbers': lambda text: re.sub(r"\d+(?:\.\d+)?", "<NUM>", text),
+    'lowercase': lambda text: text.lower(),
+}
+def RegisterLLMNormalizer(name, func):
+    """Register a prompt normalizer, so that it can be selected by name in the `normalizers` of the semantic cache. Please refer to `LLMSemanticCache`.
+
+    Args:
+        name (str): The name of the normalizer.
+        func (callable): A function mapping a text to its normalized text. It should be deterministic.
+    Returns:
+        None
+    """
+    LLM_NORMALIZERS[name] = func
+
+class LLMSemanticCache(object):
+    """An opt-in second-level cache of an LLM instance, answering prompts that only differ from a cached prompt in details such as whitespace, timestamps or request IDs.
+
+    It is enabled by `semantic_cache` in `config.json` (please refer to `LLMInit`), containing any of:
+        normalizers (list): The normalizers applied in order to the text of every message, each is the name of a registered normalizer (please refer to `LLM_NORMALIZERS` and `RegisterLLMNormalizer`) or a dict of `pattern` and `repl` for `re.sub`. Default is `["timestamps", "uuids", "whitespace"]`.
+        index (str): If `minhash`, also index the normalized prompts with MinHash signatures of their word shingles and LSH buckets, and answer a prompt with the most similar cached prompt whose estimated Jaccard similarity is at least `threshold`. If None (default), only prompts that are identical after normalization are matched.
+        threshold (float): The minimum similarity of the `minhash` index. Default is 0.9.
+        num_perm (int): The number of hash functions of the MinHash signatures. Default is 64.
+        bands (int): The number of LSH bands, which should divide `num_perm`. More bands find more candidates of lower similarity. Default is 16.
+        shingle (int): The number of words of a shingle. Default is 3.
+
+    Only prompts with the same model, temperature, seed, functions and normalizers are matched. The responses are saved under `<path>/semantic/cache` and the index in `<path>/semantic/index.db`. The hash functions are derived from `blake2b`, so that the signatures are deterministic across processes and machines, and no model or network is needed.
+    """
+    PRIME = (1 << 61) - 1
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS signatures (h TEXT PRIMARY KEY, header TEXT, signature BLOB)",
+        "CREATE TABLE IF NOT EXISTS bands (header TEXT, band INTEGER, bucket BLOB, h TEXT)",
+        "CREATE INDEX IF NOT EXISTS bands_bucket ON bands (header, band, bucket)",
+        "CREATE INDEX IF NOT EXISTS bands_h ON bands (h)",
+    ]
+    def __init__(self, path, config):
+        """
+        Args:
+            path (str): The LLM instance path.
+            config (dict): The `semantic_cache` config.
+        """
+        self.cache = pjoin(path, "semantic", "cache"); self.names = list(config.get('normalizers', ["timestamps", "uuids", "whitespace"])); self.normalizers = list()
+        for normalizer in self.names:
+            if isinstance(normalizer, dict):
+                self.normalizers.append(functools.partial(re.sub, re.compile(normalizer['pattern']), normalizer.get('repl', "")))
+            else:
+                assert (normalizer in LLM_NORMALIZERS), (f"LLM normalizer '{normalizer}' not found! Supported normalizers: {list(LLM_NORMALIZERS)}")
+                self.normalizers.append(LLM_NORMALIZERS[normalizer])
+        self.index = config.get('index', None); self.threshold = config.get('threshold', 0.9); self.num_perm = config.get('num_perm', 64); self.bands = config.get('bands', 16); self.shingle = config.get('shingle', 3)
+        assert (self.index in [None, 'minhash']), (f"Semantic cache index '{self.index}' not found! Supported indexes: [None, 'minhash']")
+        assert (self.num_perm % self.bands == 0), ("The number of bands should divide the number of hash functions!")
+        digests = [hashlib.blake2b(f"pyheaven-minhash-{i}".encode('utf-8'), digest_size=16).digest() for i in range(self.num_perm)]
+        self.perms = [(int.from_bytes(d[:8], 'little') % (self.PRIME - 1) + 1, int.from_bytes(d[8:], 'little') % self.PRIME) for d in digests]
+        if not ExistFile(pjoin(self.cache, CACHE_CONFIG_FILE)):
+            CacheInit(self.cache, clear=False, key_hash='blake2b-v1')
+        self.conns = SQLiteConnections(pjoin(path, "semantic", "index.db"), schema=self.SCHEMA) if self.index is not None else None
+
+    def normalize(self, messages):
+        """Apply the normalizers to the text of every message.
+
+        Args:
+            messages (list): The list of messages.
+        Returns:
+            list: The normalized messages.
+        """
+        def text(value):
+            for normalizer in self.normalizers:
+                value = normalizer(value)
+            return value
+        normalized = list()
+        for message in messages:
+            message = dict(message); content = message.get('content', None)
+            if isinstance(content, str):
+                message['content'] = text(content)
+            elif isinstance(content, list):
+                message['content'] = [{**part, 'text': text(part['text'])} if isinstance(part, dict) and isinstance(part.get('text'), str) else part for part in content]
+            normalized.append(message)
+        return normalized
+
+    def signature(self, messages):
+        # MinHash of the word shingles, with the universal hashes `(a*x+b) mod p` of the 64-bit blake2b hashes of the shingles
+        texts = [f"{message['role']} {message['content']}" if set(message) == {'role', 'content'} and isinstance(message['content'], str) else CanonicalKey(message) for message in messages]
+        words = re.findall(r"\w+|[^\w\s]", "\n".join(texts))
+        if not words:
+            return None
+        hashes = [int.from_bytes(hashlib.blake2b(" ".join(words[i:i+self.shingle]).encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'little') for i in range(max(1, len(words)-self.shingle+1))]
+        hashes = list(set(hashes)); p = self.PRIME
+        return [min((a*x+b) % p for x in hashes) for a, b in self.perms]
+
+    def probe(self, messages, functions, model, temperature, seed):
+        """Normalize a prompt for `get` and `set`.
+
+        Args:
+            messages (list): The list of messages.
+            functions (list): The list of functions.
+            model (str): The model.
+            temperature (float): The temperature.
+            seed (int): The seed.
+        Returns:
+            tuple: The key of the normalized prompt, the header (which prompts are comparable) and the MinHash signature (None without the index).
+        """
+        normalized = self.normalize(messages)
+        header = {'v': 1, 'model': model, 'T': f"{temperature:05.3f}", 'seed': seed, 'functions': BLAKE2B(functions) if functions else None, 'normalizers': self.names}
+        return {**header, 'prompt': BLAKE2B(normalized)}, BLAKE2B(header), (self.signature(normalized) if self.index is not None else None)
+
+    def get(self, probe):
+        """Look up the response of a normalized prompt.
+
+        Args:
+            probe (tuple): The normalized prompt, as returned by `probe`.
+        Returns:
+            Tuple(dict, float): The cached response and its similarity to the prompt (1.0 if the normalized prompts are identical), or (None, None) on a miss.
+        """
+        key, header, signature = probe; store = CacheGetStore(self.cache)
+        response = cache_get(store, store.hash(key))
+        if response is not CACHE_MISSING:
+            return response, 1.0
+        if signature is None:
+            return None, None
+        conn = self.conns.connect(); candidates = set()
+        for band in range(self.bands):
+            bucket = self.bucket(signature, band)
+            candidates.update(row[0] for row in conn.execute("SELECT h FROM bands WHERE header=? AND band=? AND bucket=?", (header, band, bucket)))
+        scored = list()
+        for h in candidates:
+            row = conn.execute("SELECT signature FROM signatures WHERE h=?", (h,)).fetchone()
+            if row is not None:
+                similarity = sum(x == y for x, y in zip(signature, struct.unpack(f"<{self.num_perm}Q", row[0]))) / self.num_perm
+                if similarity >= self.threshold:
+                    scored.append((-similarity, h))
+        # Ties are broken by the hash, so that the same prompt is always answered by the same entry
+        for negative, h in sorted(scored):
+            response = cache_get(store, h)
+            if response is not CACHE_MISSING:
+                return response, -negative
+        return None, None
+
+    def set(self, probe, response):
+        """Save the response of a normalized prompt.
+
+        Args:
+            probe (tuple): The normalized prompt, as returned by `probe`.
+            response (dict): The response.
+        Returns:
+            None
+        """
+        key, header, signature = probe; store = CacheGetStore(self.cache); h = store.hash(key)
+        CacheSet(self.cache, key, response)
+        if signature is not None:
+            conn = self.conns.connect()
+            with conn:
+                conn.execute("DELETE FROM bands WHERE h=?", (h,))
+                conn.execute("INSERT OR REPLACE INTO signatures VALUES (?, ?, ?)", (h, header, struct.pack(f"<{self.num_perm}Q", *signature)))
+                conn.executemany("INSERT INTO bands VALUES (?, ?, ?, ?)", [(header, band, self.bucket(signature, band), h) for band in range(self.bands)])
+
+    def bucket(self, signature, band):
+        r = self.num_perm // self.bands
+        return hashlib.blake2b(struct.pack(f"<{r}Q", *signature[band*r:(band+1)*r]), digest_size=8).digest()
+
+LLM_SEMANTIC_CACHES = dict()
+def llm_semantic(path):
+    # The semantic cache of an LLM instance, or None if it is not enabled, cached until the config changes
+    config = LLMLoadConfig(path); key = os.path.abspath(path); cached = LLM_SEMANTIC_CACHES.get(key, None)
+    if cached is None or cached[0] is not config:
+        cached = LLM_SEMANTIC_CACHES[key] = (config, LLMSemanticCache(path, config['semantic_cache']) if isinstance(config.get('semantic_cache'), dict) else None)
+    return cached[1]
 
+def llm_cache_get(path, identifier, messages, functions, model, temperature, seed):
+    # Look up the exact identifier, then the semantic cache if enabled, return the response (or None) and the probe for `llm_cache_set`
     response = CacheGet(pjoin(path, "cache"), identifier, default=None)
     if response is not None:
+        return response, None
+    semantic = llm_semantic(path)
+    if semantic is None:
+        return None, None
+    probe = semantic.probe(messages, functions, model, temperature, seed)
+    return semantic.get(probe)[0], probe
+
+def llm_cache_set(path, identifier, probe, response):
+    CacheSet(pjoin(path, "cache"), identifier, response)
+    if probe is not None:
+        llm_semantic(path).set(probe, response)
+
+def LLMSemanticLookup(path, messages, functions=list(), backend=None, model=None, temperature=None, seed=None):
+    """Look up a prompt in the semantic cache of an LLM instance without querying, e.g., to inspect which cached prompt would answer it. Please refer to `LLMSemanticCache`.
+
+    Args:
+        path (str): The LLM instance path.
+        messages (list/str): The list of messages. Please refer to `LLMQuery`.
+        functions (list): The list of functions.
+        backend (str): The backend to be used. If None, the default backend of the config is used.
+        model (str): The model to be used.
+        temperature (float): The temperature to be used.
+        seed (int): The seed to be used.
+    Returns:
+        Tuple(str, float): The cached response and its similarity to the prompt, or (None, None) on a miss.
+    """
+    semantic = llm_semantic(path)
+    assert (semantic is not None), ("The semantic cache is not enabled, please set `semantic_cache` in the LLM config!")
+    backend_config, _ = llm_backend(path, backend)
+    messages, model, temperature, seed, _ = llm_identifier(path, backend_config, messages, functions, model=model, temperature=temperature, seed=seed)
+    response, similarity = semantic.get(semantic.probe(messages, functions, model, temperature, seed))
+    return (response['content'], similarity) if response is not None else (None, None)
+
+class LLMRateLimiter(object):
+    """A token-bucket limiter of requests per minute and tokens per minute of a backend, shared by all processes using the same LLM instance path.
+
+    The state of the buckets (the available requests, the available tokens and the time of the last update) lives in a small file under `<path>/limits`, which is updated under an exclusive `fcntl.flock`, so that all workers draw from the same buckets. Each bucket holds at most one minute of budget and refills continuously. On platforms without `fcntl`, the buckets are only shared by the threads of the current process.
+    """
+    STATE = struct.Struct("<ddd")
+    def __init__(self, file, rpm=None, tpm=None):
+        """
+        Args:
+            file (str): The state file.
+            rpm (float): The maximum number of requests per minute. If None, requests are not limited.
+            tpm (float): The maximum number of tokens per minute. If None, tokens are not limited.
+        """
+        self.file = file; self.rpm = rpm; self.tpm = tpm; self.lock = threading.Lock(); self.state = None
+        CreateFolder(os.path.dirname(file))
+
+    def update(self, requests=0, tokens=0, force=False):
+        # Refill the buckets and try to take `requests` and `tokens` from them, return the time to wait before the buckets can afford them
+        with self.lock:
+            fd = os.open(self.file, os.O_RDWR | os.O_CREAT, 0o666) if 'fcntl' in globals() else None
+            try:
+                if fd is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX); data = os.pread(fd, self.STATE.size, 0)
+                    self.state = self.STATE.unpack(data) if len(data) == self.STATE.size else None
+                now = time.time(); rpm = self.rpm or 0.0; tpm = self.tpm or 0.0
+                level_requests, level_tokens, last = self.state if self.state is not None else (rpm, tpm, now)
+                level_requests = min(rpm, level_requests + (now - last) * rpm / 60.0)
+                level_tokens = min(tpm, level_tokens + (now - last) * tpm / 60.0)
+                # A request larger than the whole bucket is let through once the bucket is full, instead of waiting forever
+                wait = 0.0
+                if self.rpm and level_requests < min(requests, rpm):
+                    wait = max(wait, (min(requests, rpm) - level_requests) * 60.0 / rpm)
+                if self.tpm and level_tokens < min(tokens, tpm):
+                    wait = max(wait, (min(tokens, tpm) - level_tokens) * 60.0 / tpm)
+                if wait == 0.0 or force:
+                    level_requests -= requests if self.rpm else 0.0; level_tokens -= tokens if self.tpm else 0.0; wait = 0.0
+                self.state = (level_requests, level_tokens, now)
+                if fd is not None:
+                    os.pwrite(fd, self.STATE.pack(*self.state), 0)
+            finally:
+                if fd is not None:
+                    os.close(fd)
+            return wait
+
+    def acquire(self, tokens=0):
+        """Block until one request with `tokens` tokens is allowed."""
+        while True:
+            wait = self.update(requests=1, tokens=tokens)
+            if wait <= 0.0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=0):
+        """Wait until one request with `tokens` tokens is allowed, without blocking the event loop."""
+        while True:
+            wait = self.update(requests=1, tokens=tokens)
+            if wait <= 0.0:
+                return
+            await asyncio.sleep(wait)
+
+    def adjust(self, tokens):
+        """Take `tokens` more tokens (or give them back if negative) once the actual usage of a request is known."""
+        if self.tpm and tokens:
+            self.update(tokens=tokens, force=True)
+
+LLM_LIMITERS = dict()
+def LLMGetRateLimiter(path, backend=None):
+    """Get the rate limiter of a backend of an LLM instance, configured by `rate_limit` of the backend in `config.json`, e.g., `"rate_limit": {"rpm": 500, "tpm": 200000}`.
+
+    Args:
+        path (str): The LLM instance path.
+        backend (str): The backend. If None, the default backend of the config is used.
+    Returns:
+        LLMRateLimiter: The rate limiter, or None if the backend is not rate limited.
+    """
+    config = LLMLoadConfig(path)
+    if backend is None:
+        backend = config.get("default_backend", config.get("default-api"))
+    limit = config.get(backend, dict()).get('rate_limit', None) or dict()
+    if not limit.get('rpm') and not limit.get('tpm'):
+        return None
+    key = (os.path.abspath(path), backend); limiter = LLM_LIMITERS.get(key, None)
+    if limiter is None or (limiter.rpm, limiter.tpm) != (limit.get('rpm'), limit.get('tpm')):
+        limiter = LLM_LIMITERS[key] = LLMRateLimiter(pjoin(path, "limits", f"{backend}.bucket"), rpm=limit.get('rpm'), tpm=limit.get('tpm'))
+    return limiter
+
+def llm_estimate_tokens(messages, functions=list()):
+    # A rough estimate of the prompt tokens (about 4 characters per token), corrected by the actual usage after the request
+    return len(json.dumps([list(messages), functions], ensure_ascii=False, default=str)) // 4 + 1
+
+def llm_retry_after(error):
+    # The delay requested by the server through `retry-after-ms` or `Retry-After` (seconds or an HTTP date)
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers['retry-after-ms']) / 1000.0
+        if headers.get('retry-after') is not None:
+            value = headers['retry-after']
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+    return None
+
+def llm_backoff(attempt, retry_gap=0.1, max_retry_gap=60.0, error=None):
+    # Exponential backoff with full jitter, so that workers failing together do not retry in lockstep, but never earlier than the server asks
+    delay = random.uniform(0.0, min(max_retry_gap, retry_gap * (2 ** attempt)))
+    retry_after = llm_retry_after(error) if error is not None else None
+    return max(delay, min(retry_after, max_retry_gap)) if retry_after is not None else delay
+
+class LLMTelemetry(object):
+    """An append-only log of the LLM queries of an LLM instance, shared by all processes using the same LLM instance path.
+
+    Each query appends one JSON line to `<path>/telemetry.jsonl`, containing the `time` when it finished, the `pid`, the `backend`, the `model`, the `mode` (`sync`, `async` or `stream`), the `cache` outcome (`hit`, `semantic` or `miss`), the wall time `latency` in seconds (and `first_delta`, the time to the first delta of streams), the number of `retries`, the `prompt_tokens`, `completion_tokens` and `total_tokens` (of the cached response for hits, None if the backend does not report them) and the `error` if all retries failed, and the `route` of routed queries. Please refer to `LLMTelemetryStats` for aggregating the log.
+    """
+    def __init__(self, file):
+        """
+        Args:
+            file (str): The log file.
+        """
+        self.file = file; self.lock = threading.Lock(); self.f = None; self.pid = None
+
+    def record(self, backend, model, mode, cache, started, response=None, retries=0, error=None, first_delta=None, route=None):
+        """Append the record of a query.
+
+        Args:
+            backend (str): The backend.
+            model (str): The model.
+            mode (str): `sync`, `async` or `stream`.
+            cache (str): `hit`, `semantic` or `miss`.
+            started (float): The `time.perf_counter()` when the query started.
+            response (dict): The response, whose `usage` is recorded.
+            retries (int): The number of retries.
+            error (Exception): The last error if the query failed.
+            first_delta (float): The `time.perf_counter()` of the first delta of a stream.
+            route (str): The name of the route if the query is routed, where `backend` is the backend answering the query.
+        Returns:
+            None
+        """
+        finished = time.perf_counter(); usage = (response.get('usage', None) if response is not None else None) or dict()
+        record = {'time': time.time(), 'pid': os.getpid(), 'backend': backend, 'model': model, 'mode': mode, 'cache': cache, 'latency': finished - started, 'retries': retries,
+            'prompt_tokens': usage.get('prompt_tokens'), 'completion_tokens': usage.get('completion_tokens'), 'total_tokens': usage.get('total_tokens'), 'error': repr(error) if error is not None else None}
+        if first_delta is not None:
+            record['first_delta'] = first_delta - started
+        if route is not None:
+            record['route'] = route
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self.lock:
+            if self.f is None or self.pid != os.getpid():
+                # Lines are appended with a single write each, so that concurrent processes do not interleave their records
+                self.f = open(self.file, "a", encoding="utf-8"); self.pid = os.getpid()
+            self.f.write(line); self.f.flush()
+
+LLM_TELEMETRY = dict()
+def llm_telemetry(path):
+    # The telemetry log of an LLM instance, or None if it is disabled, cached until the config changes
+    config = LLMLoadConfig(path); key = os.path.abspath(path); cached = LLM_TELEMETRY.get(key, None)
+    if cached is None or cached[0] is not config:
+        telemetry = cached[1] if cached is not None and cached[1] is not None else LLMTelemetry(pjoin(path, "telemetry.jsonl"))
+        cached = LLM_TELEMETRY[key] = (config, telemetry if config.get('telemetry', False) else None)
+    return cached[1]
+
+def llm_backend_name(path, backend=None):
+    return backend if backend is not None else LLMLoadConfig(path).get("default_backend", LLMLoadConfig(path).get("default-api"))
+
+def llm_percentile(values, q):
+    # Nearest-rank percentile of sorted values
+    return values[max(0, min(len(values)-1, int(math.ceil(q * len(values))) - 1))] if values else None
+
+def LLMTelemetryStats(path, group_by=("backend", "model"), since=None):
+    """Aggregate the telemetry log of an LLM instance, e.g., to find the backends and models where latency or tokens are spent. Please refer to `LLMTelemetry`.
+
+    Args:
+        path (str): The LLM instance path.
+        group_by (list): The fields of the records to group by, e.g., `("backend", "model", "mode")`. If empty, all records are aggregated together.
+        since (float): If provided, only aggregate the records after this timestamp.
+    Returns:
+        dict: The statistics of each group (keyed by the tuple of the values of `group_by`), containing the number of `queries`, `hits` (including the `semantic_hits`), `misses`, `failures` and `retries`, the `hit_rate`, the `latency_p50` and `latency_p95` of the misses (i.e., the queries answered by the backend), the `hit_latency_p50` of the hits, the `prompt_tokens` and `completion_tokens` spent by the misses, the `tokens_per_second` (completion tokens over the latency of the misses reporting their usage), and the cache savings `saved_tokens` (the tokens of the cached responses of the hits) and `saved_seconds` (the hits times the average latency of the misses, minus the latency of the hits).
+    """
+    groups = dict(); file = pjoin(path, "telemetry.jsonl")
+    if ExistFile(file):
+        with open(file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # A partially written line of a crashed process
+                if since is not None and record['time'] < since:
+                    continue
+                groups.setdefault(tuple(record.get(field) for field in group_by), list()).append(record)
+    stats = dict()
+    for group, records in groups.items():
+        hits = [r for r in records if r['cache'] != 'miss']; misses = [r for r in records if r['cache'] == 'miss' and r['error'] is None]
+        latencies = sorted(r['latency'] for r in misses); hit_latencies = sorted(r['latency'] for r in hits)
+        completion_tokens = sum(r['completion_tokens'] or 0 for r in misses); miss_seconds = sum(latencies)
+        generation_seconds = sum(r['latency'] for r in misses if r['completion_tokens'] is not None)
+        stats[group] = {
+            'queries': len(records), 'hits': len(hits), 'semantic_hits': sum(r['cache'] == 'semantic' for r in hits), 'misses': len(records) - len(hits),
+            'failures': sum(r['error'] is not None for r in records), 'retries': sum(r['retries'] for r in records), 'hit_rate': len(hits) / len(records),
+            'latency_p50': llm_percentile(latencies, 0.50), 'latency_p95': llm_percentile(latencies, 0.95), 'hit_latency_p50': llm_percentile(hit_latencies, 0.50),
+            'prompt_tokens': sum(r['prompt_tokens'] or 0 for r in misses), 'completion_tokens': completion_tokens,
+            'tokens_per_second': completion_tokens / generation_seconds if generation_seconds > 0 else None,
+            'saved_tokens': sum(r['total_tokens'] or 0 for r in hits),
+            'saved_seconds': len(hits) * miss_seconds / len(latencies) - sum(hit_latencies) if latencies else None,
+        }
+    return stats
+
+def llm_query_stream(path, instance, messages, functions, identifier, limiter=None, model=None, temperature=None, seed=None, retry_time=3, retry_gap=0.1, max_retry_gap=60.0, backend=None, telemetry=None, started=None):
+    # Cache hits are replayed as a single delta, misses are cached once the stream completes
+    response, probe = llm_cache_get(path, identifier, messages, functions, model, temperature, seed)
+    if response is not None:
+        if telemetry is not None:
+            telemetry.record(backend, model, 'stream', 'hit' if probe is None else 'semantic', started, response)
+        if response['content']:
+            yield response['content']
+        return
+    tokens = llm_estimate_tokens(messages, functions) if limiter is not None else 0; attempt = 0; error = None
+    while retry_time != 0:
+        first_delta = None
+        try:
+            if limiter is not None:
+                limiter.acquire(tokens)
+            stream = LLMStreamQueryAPI(instance, messages, functions, model=model, temperature=temperature, seed=seed)
+            while True:
+                try:
+                    delta = next(stream)
+                except StopIteration as stop:
+                    response = stop.value; break
+                if first_delta is None:
+                    first_delta = time.perf_counter()
+                yield delta
+            llm_cache_set(path, identifier, probe, response); break
+        except Exception as e:
+            # Deltas already yielded can not be taken back, so only failures before the first delta are retried
+            if first_delta is not None:
+                if telemetry is not None:
+                    telemetry.record(backend, model, 'stream', 'miss', started, retries=attempt, error=e, first_delta=first_delta)
+                raise
+            print(e); error = e; retry_time -= 1
+            if retry_time != 0:
+                time.sleep(llm_backoff(attempt, retry_gap=retry_gap, max_retry_gap=max_retry_gap, error=e)); attempt += 1
+    else:
+        if telemetry is not None:
+            telemetry.record(backend, model, 'stream', 'miss', started, retries=attempt, error=error)
+        return
+    if telemetry is not None:
+        telemetry.record(backend, model, 'stream', 'miss', started, response, retries=attempt, first_delta=first_delta)
+
+def LLMQuery(path, messages, functions=list(), backend=None, model=None, temperature=None, seed=None, retry_time=3, retry_gap=0.1, max_retry_gap=60.0, stream=False):
+    """Query an LLM instance. Support config, caching and retrying.
+    
+    Currently only OpenAI API is supported (aiml and vertex are accessed through `base_url`). You need to set the OpenAI API key and organization before using this function. The config and the client are reused across calls, please refer to `LLMLoadConfig` and `LLMClient`. Requests are rate limited if `rate_limit` is configured for the backend, please refer to `LLMGetRateLimiter`. Prompts missing the cache are looked up in the semantic cache if it is enabled, please refer to `LLMSemanticCache`.
+    
+    Args:
+        path (str): The LLM instance path.
+        messages (list/str/LLMPrompt): The list of messages to query. If passed in as a string, it will be converted to a simple message: [{'role':'user', 'content': '<messages>'}]. Prompts sharing long leading messages should be built with `LLMTemplate`, so that the shared messages are only hashed and stored once.
+        functions (list): The list of functions to query.
+        backend (str/list/dict): The backend to be used. If None, the default backend of the config is used. A route of backends is queried if `backend` is the name of a route in `routes` of the config (please refer to `LLMInit`), a list of backends (tried in order) or a dict of backends and their weights (tried in a random order, where the first backend is chosen with probability proportional to its weight). A route fails over to the next backend on errors, and, if `hedge` is set for the route, also sends the query to the next backend when the current one has not answered within the hedge delay, taking whichever answers first. The response is cached under the route instead of the backend answering it (the model `route:<name>`, unless `model` is provided), and each retry is a round over the backends. Routes do not support `stream`.
+        model (str): The model to be used. For routes, all the backends use this model if provided, otherwise each backend uses its own model.
+        temperature (float): The temperature to be used.
+        seed (int): The seed to be used.
+        retry_time (int): The maximum number of retries. If `retry_time` is 0, the function will be executed only once. If `retry_time` is smaller than 0, the function will be executed indefinitely until it succeeds.
+        retry_gap (float): The initial time gap between retries. The gap doubles after each failed attempt, with a random jitter, and follows the `Retry-After` header of the server if it asks for a longer gap.
+        max_retry_gap (float): The maximum time gap between retries.
+        stream (bool): If True, return a generator yielding the content deltas as they arrive. The assembled response is cached when the stream completes, and a cached response is replayed through the same generator (as a single delta). Only failures before the first delta are retried.
+    Returns:
+        str: The response of the LLM instance, or None if all retries fail. If `stream` is True, a generator of the content deltas.
+    """
+    route = llm_route(path, backend)
+    if route is not None:
+        assert (not stream), ("Streaming is not supported by routes of backends!")
+        return llm_query_route(path, route, messages, functions, model=model, temperature=temperature, seed=seed, retry_time=retry_time, retry_gap=retry_gap, max_retry_gap=max_retry_gap)
+    started = time.perf_counter(); telemetry = llm_telemetry(path)
+    backend_config, _ = llm_backend(path, backend); instance = LLMClient(path, backend)
+    messages, model, temperature, seed, identifier = llm_identifier(path, backend_config, messages, functions, model=model, temperature=temperature, seed=seed)
+    if stream:
+        return llm_query_stream(path, instance, messages, functions, identifier, limiter=LLMGetRateLimiter(path, backend), model=model, temperature=temperature, seed=seed, retry_time=retry_time, retry_gap=retry_gap, max_retry_gap=max_retry_gap,
+            backend=llm_backend_name(path, backend), telemetry=telemetry, started=started)
+
+    response, probe = llm_cache_get(path, identifier, messages, functions, model, temperature, seed)
+    if response is not None:
+        if telemetry is not None:
+            telemetry.record(llm_backend_name(path, backend), model, 'sync', 'hit' if probe is None else 'semantic', started, response)
+        return response['content']
+    limiter = LLMGetRateLimiter(path, backend); tokens = llm_estimate_tokens(messages, functions) if limiter is not None else 0; attempt = 0; error = None
+    while retry_time != 0:
+        try:
+            if limiter is not None:
+                limiter.acquire(tokens)
+            response = LLMSimpleQueryAPI(instance, messages, functions, model=model, temperature=temperature, seed=seed)
+            if limiter is not None and response['usage'] is not None:
+                limiter.adjust(response['usage']['total_tokens'] - tokens)
+            llm_cache_set(path, identifier, probe, response); break
+        except Exception as e:
+            print(e); error = e; retry_time -= 1
+            if retry_time != 0:
+                time.sleep(llm_backoff(attempt, retry_gap=retry_gap, max_retry_gap=max_retry_gap, error=e)); attempt += 1
+    else:
+        if telemetry is not None:
+            telemetry.record(llm_backend_name(path, backend), model, 'sync', 'miss', started, retries=attempt, error=error)
+        return None
+    if telemetry is not None:
+        telemetry.record(llm_backend_name(path, backend), model, 'sync', 'miss', started, response, retries=attempt)
+    return response['content']
+
+async def llm_query_async(path, instance, messages, functions=list(), backend_config=dict(), limiter=None, model=None, temperature=None, seed=None, retry_time=3, retry_gap=0.1, max_retry_gap=60.0, backend=None):
+    # Query with the same cache semantics as `LLMQuery`, but raise the last error when all retries fail
+    started = time.perf_counter(); telemetry = llm_telemetry(path)
+    messages, model, temperature, seed, identifier = llm_identifier(path, backend_config, messages, functions, model=model, temperature=temperature, seed=seed)
+    response, probe = llm_cache_get(path, identifier, messages, functions, model, temperature, seed)
+    if response is not None:
+        if telemetry is not None:
+            telemetry.record(llm_backend_name(path, backend), model, 'async', 'hit' if probe is None else 'semantic', started, response)
         return response['content']
-    def llm_query():
-        response = LLMSimpleQueryAPI(instance, messages, functions, model=model, temperature=temperature, seed=seed)
-        CacheSet(pjoin(path, "cache"), identifier, response); return response['content']
-    content = Attempt(llm_query, retry_time=retry_time, retry_gap=retry_gap, default=None, verbose=True)
-    return content
\ No newline at end of file
+    tokens = llm_estimate_tokens(messages, functions) if limiter is not None else 0; attempt = 0; error = None
+    while retry_time != 0:
+        try:
+            if limiter is not None:
+                await limiter.acquire_async(tokens)
+            response = await LLMSimpleQueryAPIAsync(instance, messages, functions, model=model, temperature=temperature, seed=seed)
+            if limiter is not None and response['usage'] is not None:
+                limiter.adjust(response['usage']['total_tokens'] - tokens)
+            llm_cache_set(path, identifier, probe, response); break
+        except Exception as e:
+            error = e; retry_time -= 1
+            if retry_time != 0:
+                await asyncio.sleep(llm_backoff(attempt, retry_gap=retry_gap, max_retry_gap=max_retry_gap, error=e)); attempt += 1
+    else:
+        if telemetry is not None:
+            telemetry.record(llm_backend_name(path, backend), model, 'async', 'miss', started, retries=attempt, error=error)
+        raise error if error is not None else Exception("The LLM query is not attempted since `retry_time` is 0.")
+    if telemetry is not None:
+        telemetry.record(llm_backend_name(path, backend), model, 'async', 'miss', started, response, retries=attempt)
+    return response['content']
+
+async def LLMQueryAsync(path, messages, functions=list(), backend=None, model=None, temperature=None, seed=None, retry_time=3, retry_gap=0.1, max_retry_gap=60.0):
+    """Query an LLM instance asynchronously with the async OpenAI client. Support config, caching and retrying, with the same cache as `LLMQuery`.
+
+    Args:
+        path (str): The LLM instance path.
+        messages (list/str): The list of messages to query. Please refer to `LLMQuery`.
+        functions (list): The list of functions to query.
+        backend (str/list/dict): The backend or the route of backends to be used. Please refer to `LLMQuery`.
+        model (str): The model to be used.
+        temperature (float): The temperature to be used.
+        seed (int): The seed to be used.
+        retry_time (int): The maximum number of retries. Please refer to `LLMQuery`.
+        retry_gap (float): The initial time gap between retries. Please refer to `LLMQuery`.
+        max_retry_gap (float): The maximum time gap between retries.
+    Returns:
+        str: The response of the LLM instance, or None if all retries fail.
+    """
+    try:
+        route = llm_route(path, backend)
+        if route is not None:
+            return await llm_query_route_async(path, route, messages, functions, model=model, temperature=temperature, seed=seed, retry_time=retry_time, retry_gap=retry_gap, max_retry_gap=max_retry_gap)
+        backend_config, _ = llm_backend(path, backend); instance = LLMClientAsync(path, backend)
+        return await llm_query_async(path, instance, messages, functions, backend_config=backend_config, limiter=LLMGetRateLimiter(path, backend), model=model, temperature=temperature, seed=seed, retry_time=retry_time, retry_gap=retry_gap, max_retry_gap=max_retry_gap, backend=backend)
+    except Exception as e:
+        print(e); return None
+
+async def LLMQueryBatchAsync(path, list_of_messages, functions=list(), backend=None, model=None, temperature=None, seed=None, max_concurrency=16, retry_time=3, retry_gap=0.1, max_retry_gap=60.0):
+    """Query an LLM instance with a batch of prompts asynchronously, with at most `max_concurrency` requests in flight. Please refer to `LLMQueryBatch`."""
+    route = llm_route(path, backend); semaphore = asyncio.Semaphore(max_concurrency)
+    if route is not None:
+        async def query(messages):
+            async with semaphore:
+                return await llm_query_route_async(path, route, messages, functions, model=model, temperature=temperature, seed=seed, retry_time=retry_time, retry_gap=retry_gap, max_retry_gap=max_retry_gap)
+        return list(await asyncio.gather(*[query(messages) for messages in list_of_messages], return_exceptions=True))
+    backend_config, _ = llm_backend(path, backend); instance = LLMClientAsync(path, backend); limiter = LLMGetRateLimiter(path, backend)
+    async def query(messages):
+        async with semaphore:
+            return await llm_query_async(path, instance, messages, functions, backend_config=backend_config, limiter=limiter, model=model, temperature=temperature, seed=seed, retry_time=retry_time, retry_gap=retry_gap, max_retry_gap=max_retry_gap, backend=backend)
+    return list(await asyncio.gather(*[query(messages) for messages in list_of_messages], return_exceptions=True))
+
+def LLMQueryBatch(path, list_of_messages, functions=list(), backend=None, model=None, temperature=None, seed=None, max_concurrency=16, retry_time=3, retry_gap=0.1, max_retry_gap=60.0):
+    """Query an LLM instance with a batch of prompts concurrently, using the async OpenAI client (with a single connection pool) and at most `max_concurrency` requests in flight. Cached prompts are answered from the same cache as `LLMQuery` without any request.
+
+    From a running event loop, use `await LLMQueryBatchAsync(...)` with the same arguments instead.
+
+    Args:
+        path (str): The LLM instance path.
+        list_of_messages (list): The list of prompts, each is a list of messages or a string. Please refer to `LLMQuery`.
+        functions (list): The list of functions to query, shared by all prompts.
+        backend (str): The backend to be used. If None, the default backend of the config is used.
+        model (str): The model to be used.
+        temperature (float): The temperature to be used.
+        seed (int): The seed to be used.
+        max_concurrency (int): The maximum number of concurrent requests.
+        retry_time (int): The maximum number of retries of each prompt. Please refer to `LLMQuery`.
+        retry_gap (float): The initial time gap between retries. Please refer to `LLMQuery`.
+        max_retry_gap (float): The maximum time gap between retries.
+    Returns:
+        list: The responses in the same order as `list_of_messages`. If all retries of a prompt fail, the last exception is returned in its place instead of raising, so that one failure does not lose the other results.
+    """
+    return asyncio.run(LLMQueryBatchAsync(path, list_of_messages, functions, backend=backend, model=model, temperature=temperature, seed=seed, max_concurrency=max_concurrency, retry_time=retry_time, retry_gap=retry_gap, max_retry_gap=max_retry_gap))
+
+LLM_LATENCIES = dict(); LLM_LATENCIES_WINDOW = 256; LLM_HEDGE_MIN_SAMPLES = 20
+def llm_route(path, backend=None):
+    # Resolve a route of backends, or None if `backend` is a single backend
+    config = LLMLoadConfig(path); backend = llm_backend_name(path, backend)
+    if isinstance(backend, str):
+        if backend not in config.get('routes', dict()):
+            return None
+        name, route = backend, config['routes'][backend]
+    else:
+        name, route = None, {'backends': backend}
+    backends = route['backends']; names = list(backends)
+    assert (len(names) > 0), ("A route should contain at least one backend!")
+    if name is None:
+        name = ",".join(sorted(names))
+    hedge = route.get('hedge', None); quantile = None; delay = route.get('hedge_delay', None)
+    if hedge is True:
+        quantile = 0.95
+    elif isinstance(hedge, str):
+        assert (hedge.startswith('p')), (f"Unknown hedge '{hedge}'! The hedge should be a percentile such as 'p95', or the delay in seconds.")
+        quantile = float(hedge[1:]) / 100
+    elif hedge is not None and hedge is not False:
+        delay = float(hedge)
+    default_config, _ = llm_backend(path, names[0])
+    return {'name': name, 'backends': names, 'weights': dict(backends) if isinstance(backends, dict) else None, 'quantile': quantile, 'delay': delay,
+        'config': {'model': f"route:{name}", 'temperature': route.get('temperature', default_config['temperature']), 'seed': route.get('seed', default_config['seed'])}}
+
+def llm_route_order(route):
+    # Weighted routes are shuffled by weighted sampling without replacement, so that the first backend is chosen with probability proportional to its weight
+    if route['weights'] is None:
+        return list(route['backends'])
+    return sorted(route['backends'], key=lambda backend: -random.random() ** (1.0 / route['weights'][backend]) if route['weights'][backend] > 0 else 1.0)
+
+def llm_hedge_delay(path, route, backend):
+    # The delay before hedging `backend` with the next backend of the route, None to never hedge
+    latencies = LLM_LATENCIES.get((os.path.abspath(path), backend), None)
+    if route['quantile'] is not None and latencies is not None and len(latencies) >= LLM_HEDGE_MIN_SAMPLES:
+        return llm_percentile(sorted(latencies), route['quantile'])
+    return route['delay']
+
+def llm_route_call(path, backend, messages, functions, model, temperature, seed):
+    backend_config, _ = llm_backend(path, backend); instance = LLMClient(path, backend); limiter = LLMGetRateLimiter(path, backend)
+    tokens = llm_estimate_tokens(messages, functions) if limiter is not None else 0
+    if limiter is not None:
+        limiter.acquire(tokens)
+    started = time.perf_counter(); response = LLMSimpleQueryAPI(instance, messages, functions, model=model if model is not None else backend_config['model'], temperature=temperature, seed=seed)
+    LLM_LATENCIES.setdefault((os.path.abspath(path), backend), deque(maxlen=LLM_LATENCIES_WINDOW)).append(time.perf_counter() - started)
+    if limiter is not None and response['usage'] is not None:
+        limiter.adjust(response['usage']['total_tokens'] - tokens)
+    return response
+
+async def llm_route_call_async(path, backend, messages, functions, model, temperature, seed):
+    backend_config, _ = llm_backend(path, backend); instance = LLMClientAsync(path, backend); limiter = LLMGetRateLimiter(path, backend)
+    tokens = llm_estimate_tokens(messages, functions) if limiter is not None else 0
+    if limiter is not None:
+        await limiter.acquire_async(tokens)
+    started = time.perf_counter(); response = await LLMSimpleQueryAPIAsync(instance, messages, functions, model=model if model is not None else backend_config['model'], temperature=temperature, seed=seed)
+    LLM_LATENCIES.setdefault((os.path.abspath(path), backend), deque(maxlen=LLM_LATENCIES_WINDOW)).append(time.perf_counter() - started)
+    if limiter is not None and response['usage'] is not None:
+        limiter.adjust(response['usage']['total_tokens'] - tokens)
+    return response
+
+def llm_route_round(path, route, messages, functions, model, temperature, seed):
+    # Try the backends of the route in order, failing over on errors and hedging slow backends with the next one, return the first response and its backend
+    order = llm_route_order(route); pending = dict(); error = None
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(order))
+    try:
+        while pending or order:
+            if not pending:
+                backend = order.pop(0); pending[executor.submit(llm_route_call, path, backend, messages, functions, model, temperature, seed)] = backend; launched = time.perf_counter()
+            delay = llm_hedge_delay(path, route, backend) if order else None
+            done, _ = concurrent.futures.wait(pending, timeout=max(0.0, delay - (time.perf_counter() - launched)) if delay is not None else None, return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                backend = order.pop(0); pending[executor.submit(llm_route_call, path, backend, messages, functions, model, temperature, seed)] = backend; launched = time.perf_counter(); continue
+            for future in done:
+                winner = pending.pop(future)
+                if future.exception() is None:
+                    return future.result(), winner
+                print(future.exception()); error = future.exception()
+    finally:
+        # Requests of the synchronous client can not be cancelled, the losers finish in the background and their responses are dropped
+        executor.shutdown(wait=False)
+    raise error
+
+async def llm_route_round_async(path, route, messages, functions, model, temperature, seed):
+    # The async version of `llm_route_round`, where the losers are cancelled
+    order = llm_route_order(route); pending = dict(); error = None
+    try:
+        while pending or order:
+            if not pending:
+                backend = order.pop(0); pending[asyncio.ensure_future(llm_route_call_async(path, backend, messages, functions, model, temperature, seed))] = backend; launched = time.perf_counter()
+            delay = llm_hedge_delay(path, route, backend) if order else None
+            done, _ = await asyncio.wait(pending, timeout=max(0.0, delay - (time.perf_counter() - launched)) if delay is not None else None, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                backend = order.pop(0); pending[asyncio.ensure_future(llm_route_call_async(path, backend, messages, functions, model, temperature, seed))] = backend; launched = time.perf_counter(); continue
+            for task in done:
+                winner = pending.pop(task)
+                if task.exception() is None:
+                    return task.result(), winner
+                error = task.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+    raise error
+
+def llm_query_route(path, route, messages, functions=list(), model=None, temperature=None, seed=None, retry_time=3, retry_gap=0.1, max_retry_gap=60.0):
+    # Query a route of backends with the same cache semantics as `LLMQuery`, where each retry is a round over the backends of the route
+    started = time.perf_counter(); telemetry = llm_telemetry(path); backend_model = model
+    messages, model, temperature, seed, identifier = llm_identifier(path, route['config'], messages, functions, model=model, temperature=temperature, seed=seed)
+    response, probe = llm_cache_get(path, identifier, messages, functions, model, temperature, seed)
+    if response is not None:
+        if telemetry is not None:
+            telemetry.record(route['name'], model, 'sync', 'hit' if probe is None else 'semantic', started, response, route=route['name'])
+        return response['content']
+    attempt = 0; error = None; winner = route['name']
+    while retry_time != 0:
+        try:
+            response, winner = llm_route_round(path, route, messages, functions, backend_model, temperature, seed)
+            llm_cache_set(path, identifier, probe, response); break
+        except Exception as e:
+            print(e); error = e; retry_time -= 1
+            if retry_time != 0:
+                time.sleep(llm_backoff(attempt, retry_gap=retry_gap, max_retry_gap=max_retry_gap, error=e)); attempt += 1
+    else:
+        if telemetry is not None:
+            telemetry.record(route['name'], model, 'sync', 'miss', started, retries=attempt, error=error, route=route['name'])
+        return None
+    if telemetry is not None:
+        telemetry.record(winner, model, 'sync', 'miss', started, response, retries=attempt, route=route['name'])
+    return response['content']
+
+async def llm_query_route_async(path, route, messages, functions=list(), model=None, temperature=None, seed=None, retry_time=3, retry_gap=0.1, max_retry_gap=60.0):
+    # The async version of `llm_query_route`, raising the last error when all retries fail
+    started = time.perf_counter(); telemetry = llm_telemetry(path); backend_model = model
+    messages, model, temperature, seed, identifier = llm_identifier(path, route['config'], messages, functions, model=model, temperature=temperature, seed=seed)
+    response, probe = llm_cache_get(path, identifier, messages, functions, model, temperature, seed)
+    if response is not None:
+        if telemetry is not None:
+            telemetry.record(route['name'], model, 'async', 'hit' if probe is None else 'semantic', started, response, route=route['name'])
+        return response['content']
+    attempt = 0; error = None; winner = route['name']
+    while retry_time != 0:
+        try:
+            response, winner = await llm_route_round_async(path, route, messages, functions, backend_model, temperature, seed)
+            llm_cache_set(path, identifier, probe, response); break
+        except Exception as e:
+            error = e; retry_time -= 1
+            if retry_time != 0:
+                await asyncio.sleep(llm_backoff(attempt, retry_gap=retry_gap, max_retry_gap=max_retry_gap, error=e)); attempt += 1
+    else:
+        if telemetry is not None:
+            telemetry.record(route['name'], model, 'async', 'miss', started, retries=attempt, error=error, route=route['name'])
+        raise error if error is not None else Exception("The LLM query is not attempted since `retry_time` is 0.")
+    if telemetry is not None:
+        telemetry.record(winner, model, 'async', 'miss', started, response, retries=attempt, route=route['name'])
+    return response['content']
+
+def LLMBatchSubmit(path, list_of_messages, functions=list(), backend=None, model=None, temperature=None, seed=None, completion_window="24h", submit=True):
+    """Submit a batch of prompts as a single job of the batch API of the provider, instead of querying them one by one. Prompts already in the cache (or repeated in the batch) are not submitted.
+
+    The requests are written in the JSONL format of the OpenAI batch API to `<path>/batches/<name>/requests.jsonl`, together with a manifest mapping each request to the identifier `LLMQuery` uses for the prompt. Use `LLMBatchCollect` to load the results into the cache once the job completes.
+
+    Args:
+        path (str): The LLM instance path.
+        list_of_messages (list): The list of prompts, each is a list of messages or a string. Please refer to `LLMQuery`.
+        functions (list): The list of functions to query, shared by all prompts.
+        backend (str): The backend to be used. If None, the default backend of the config is used.
+        model (str): The model to be used.
+        temperature (float): The temperature to be used.
+        seed (int): The seed to be used.
+        completion_window (str): The completion window of the batch job.
+        submit (bool): If False, only write the request file (e.g., to upload it manually), and load the results with `LLMBatchCollect(..., output_file=...)`.
+    Returns:
+        str: The name of the batch, which is used to collect the results.
+    """
+    assert (llm_route(path, backend) is None), ("Batches can not be submitted to a route of backends!")
+    backend_config, _ = llm_backend(path, backend); cache = pjoin(path, "cache"); store = CacheGetStore(cache)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{random.getrandbits(32):08x}"; folder = pjoin(path, "batches", name); CreateFolder(folder)
+    identifiers = list(); requests = dict()
+    for messages in list_of_messages:
+        messages, model_, temperature_, seed_, identifier = llm_identifier(path, backend_config, messages, functions, model=model, temperature=temperature, seed=seed)
+        identifiers.append(identifier); custom_id = store.hash(identifier)
+        if custom_id in requests or CacheExist(cache, identifier):
+            continue
+        body = {'model': model_, 'messages': list(messages), 'temperature': temperature_, 'seed': seed_}
+        if functions:
+            body['functions'] = functions
+        requests[custom_id] = {'custom_id': custom_id, 'method': "POST", 'url': "/v1/chat/completions", 'body': body}
+    with open(pjoin(folder, "requests.jsonl"), "w", encoding="utf-8") as f:
+        for request in requests.values():
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+    batch_id = None
+    if submit and requests:
+        client = LLMClient(path, backend)
+        with open(pjoin(folder, "requests.jsonl"), "rb") as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        batch_id = client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window=completion_window).id
+    SavePickle({'backend': backend, 'batch_id': batch_id, 'identifiers': identifiers, 'submitted': list(requests)}, pjoin(folder, "manifest.pkl"))
+    return name
+
+def LLMBatchCollect(path, name, output_file=None, wait=False, poll_interval=60.0):
+    """Collect the results of a batch submitted by `LLMBatchSubmit` into the cache, under the same identifiers `LLMQuery` computes, so that later `LLMQuery` calls with the same prompts are answered from the cache.
+
+    Args:
+        path (str): The LLM instance path.
+        name (str): The name of the batch returned by `LLMBatchSubmit`.
+        output_file (str): If provided, load the results from this local JSONL output file of the batch API, instead of downloading them from the provider.
+        wait (bool): If True, poll the batch job every `poll_interval` seconds until it finishes. Otherwise, return None if it has not finished.
+        poll_interval (float): The time gap between polls.
+    Returns:
+        list: The responses in the same order as the prompts submitted, with None for prompts that failed. None if the batch job has not finished.
+    """
+    folder = pjoin(path, "batches", name); manifest = LoadPickle(pjoin(folder, "manifest.pkl")); cache = pjoin(path, "cache")
+    identifiers = {CacheGetStore(cache).hash(identifier): identifier for identifier in manifest['identifiers']}
+    if output_file is not None:
+        with open(output_file, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    elif manifest['batch_id'] is not None:
+        client = LLMClient(path, manifest['backend'])
+        while True:
+            batch = client.batches.retrieve(manifest['batch_id'])
+            if batch.status in ["completed", "failed", "expired", "cancelled"]:
+                break
+            if not wait:
+                return None
+            time.sleep(poll_interval)
+        lines = client.files.content(batch.output_file_id).text.splitlines() if batch.output_file_id else list()
+    else:
+        lines = list()
+    for line in lines:
+        if not line.strip():
+            continue
+        result = json.loads(line); response = result.get('response') or dict()
+        if result.get('custom_id') not in identifiers or result.get('error') or response.get('status_code', 200) != 200:
+            continue
+        body = response['body']; message = body['choices'][0]['message']
+        CacheSet(cache, identifiers[result['custom_id']], {'role':message.get('role'), 'content':message.get('content'), 'function_call':message.get('function_call'), 'tool_calls':message.get('tool_calls'), 'usage':body.get('usage')})
+    responses = [CacheGet(cache, identifier, default=None) for identifier in manifest['identifiers']]
+    return [response['content'] if response is not None else None for response in responses]
+
+def LLMCacheLookupPrefix(path, messages, model=None, prefix=None):
+    """Find the cached responses of all the conversations starting with the given messages, e.g., all the completions sharing a system prompt and few-shot examples. Requires an LLM instance whose cache is keyed by fingerprints (`"cache_key": "fingerprint-v1"` in `config.json`, the default of `LLMInit`).
+
+    Args:
+        path (str): The LLM instance path.
+        messages (list/str): The leading messages of the conversations. Please refer to `LLMFingerprint`.
+        model (str): If provided, only return the responses of this model.
+        prefix (list): The fingerprints of `messages` if already computed. Please refer to `LLMFingerprint`.
+    Returns:
+        Iterator[Tuple(dict, dict)]: An iterator over the cache keys (the header and the fingerprints of each conversation) and the cached responses.
+    """
+    assert (LLMLoadConfig(path).get("cache_key", "identifier") == "fingerprint-v1"), ("Prefix lookups require an LLM cache keyed by fingerprints!")
+    chain = prefix if prefix is not None else LLMFingerprint(messages); head = b"".join(fingerprint[:8] for fingerprint in chain)
+    def match(key):
+        return isinstance(key, dict) and key.get('v') == 1 and key['prefixes'].startswith(head) and (model is None or key['model'] == model)
+    yield from CacheItems(pjoin(path, "cache"), predicate=match)
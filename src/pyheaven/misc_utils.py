@@ -6,6 +6,7 @@ import random
 import hashlib
 Import("tqdm",globals())
 Import("requests",globals())
+Import("xxhash",globals())
 
 def RandString(length:int, charset:str=string.ascii_uppercase + string.digits):
     """Return a random string.
@@ -354,3 +355,87 @@ def MD5(key, salt=None):
         int: The integer hash value.
     """
     return int(hashlib.md5((f"{key}" if salt is None else f"{key}|{salt}").encode('utf-8')).hexdigest(), 16)
+
+
+def canonical_encode(key, parts):
+    t = type(key)
+    if t is str:
+        parts.append(f"s{len(key)}:"); parts.append(key)
+    elif t is list or t is tuple:
+        parts.append(f"{'l' if t is list else 't'}{len(key)}:")
+        for item in key:
+            canonical_encode(item, parts)
+    elif t is dict:
+        items = sorted((CanonicalKey(k), v) for k, v in key.items())
+        parts.append(f"d{len(items)}:")
+        for k, v in items:
+            parts.append(k); canonical_encode(v, parts)
+    elif t is int:
+        parts.append(f"i{key};")
+    elif t is float:
+        parts.append(f"f{key.hex()};")
+    elif key is None:
+        parts.append("n")
+    elif t is bool:
+        parts.append("T" if key else "F")
+    elif isinstance(key, (bytes, bytearray)):
+        parts.append(f"b{len(key)}:{key.hex()}")
+    elif isinstance(key, (set, frozenset)):
+        items = sorted(CanonicalKey(item) for item in key)
+        parts.append(f"e{len(items)}:"); parts.extend(items)
+    elif isinstance(key, dict):
+        canonical_encode(dict(key), parts)
+    elif isinstance(key, list):
+        canonical_encode(list(key), parts)
+    elif isinstance(key, tuple):
+        canonical_encode(tuple(key), parts)
+    elif isinstance(key, str):
+        canonical_encode(str.__str__(key), parts)
+    elif isinstance(key, int):
+        canonical_encode(int(key), parts)
+    elif isinstance(key, float):
+        canonical_encode(float(key), parts)
+    else:
+        r = repr(key); parts.append(f"o{type(key).__qualname__}|{len(r)}:"); parts.append(r)
+
+def CanonicalKey(key):
+    """Encode a key into a canonical string, which is stable across processes and python versions.
+    Nested lists, tuples, dicts, sets, strings, bytes and numbers are supported: dict items and set elements are sorted, floats are encoded exactly (`float.hex`), and every value is prefixed with its type and length so that different keys never share an encoding. Other objects are encoded with their `repr`.
+
+    This is the version 1 encoding. Any incompatible change to the encoding should be introduced as a new version, since cached hashes depend on it.
+
+    Args:
+        key: The key to be encoded.
+    Returns:
+        str: The canonical encoding.
+    """
+    parts = list(); canonical_encode(key, parts); return "".join(parts)
+
+
+def BLAKE2B(key, salt=None, digest_size=16):
+    """Generate the hex blake2b hash value for an arbitrary key, using its canonical encoding (`CanonicalKey`).
+    Unlike `MD5`, the hash value does not depend on the order of dict items or on how the key is converted to string.
+
+    Args:
+        key: The key to be hashed.
+        salt: The salt to be added to the key before hashing.
+        digest_size (int): The size of the digest in bytes.
+    Returns:
+        str: The hex hash value.
+    """
+    s = CanonicalKey(key) if salt is None else CanonicalKey(key)+"|"+CanonicalKey(salt)
+    return hashlib.blake2b(s.encode('utf-8', 'surrogatepass'), digest_size=digest_size).hexdigest()
+
+
+def XXH3(key, salt=None):
+    """Generate the hex 128-bit xxh3 hash value for an arbitrary key, using its canonical encoding (`CanonicalKey`). Requires the `xxhash` package.
+
+    Args:
+        key: The key to be hashed.
+        salt: The salt to be added to the key before hashing.
+    Returns:
+        str: The hex hash value.
+    """
+    assert ('xxhash' in globals()), ("`XXH3` requires the `xxhash` package!")
+    s = CanonicalKey(key) if salt is None else CanonicalKey(key)+"|"+CanonicalKey(salt)
+    return xxhash.xxh3_128_hexdigest(s.encode('utf-8', 'surrogatepass'))
@@ -0,0 +1,64 @@
+import os
+import sys
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+class StubServer(object):
+    """A local OpenAI-compatible chat completions server, which answers every prompt with `echo: <last message>` after `delay` seconds.
+
+    It counts the requests (`calls`) and the maximum number of requests in flight (`peak`), and answers with a server error if `fail(body)` is True.
+    """
+    def __init__(self, delay=0.0, fail=None):
+        self.delay = delay; self.fail = fail; self.calls = 0; self.active = 0; self.peak = 0; self.lock = threading.Lock()
+        stub = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def log_message(self, *args):
+                pass
+            def reply(self, code, obj):
+                data = json.dumps(obj).encode("utf-8")
+                self.send_response(code); self.send_header("Content-Type", "application/json"); self.send_header("Content-Length", str(len(data))); self.end_headers()
+                self.wfile.write(data)
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with stub.lock:
+                    stub.calls += 1; stub.active += 1; stub.peak = max(stub.peak, stub.active)
+                time.sleep(stub.delay)
+                with stub.lock:
+                    stub.active -= 1
+                if stub.fail is not None and stub.fail(body):
+                    return self.reply(500, {'error': {'message': "stub failure", 'type': "server_error"}})
+                content = "echo: " + body['messages'][-1]['content']
+                self.reply(200, {'id': "stub", 'object': "chat.completion", 'created': 0, 'model': body['model'],
+                    'choices': [{'index': 0, 'message': {'role': "assistant", 'content': content}, 'finish_reason': "stop"}],
+                    'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2}})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True); self.thread.start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def close(self):
+        self.server.shutdown(); self.server.server_close()
+
+@pytest.fixture
+def stub():
+    server = StubServer()
+    yield server
+    server.close()
+
+@pytest.fixture
+def llm(tmp_path, stub):
+    """An LLM instance path whose default backend is the stub server."""
+    pytest.importorskip("openai")
+    from pyheaven import LLMInit
+    path = str(tmp_path / "llm")
+    LLMInit(path, config={}, clear=False, deepseek_api_key="stub", deepseek_base_url=stub.url)
+    return path
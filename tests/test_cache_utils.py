@@ -0,0 +1,165 @@
+import os
+import time
+import signal
+import threading
+import multiprocessing
+
+import pytest
+
+from pyheaven import *
+
+def run_forked(f, timeout=20.0):
+    # Run `f` in a forked child, return its exit code, or None if it does not finish within `timeout` seconds
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            f(); code = 0
+        finally:
+            os._exit(code)
+    deadline = time.time() + timeout
+    while True:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            return os.waitstatus_to_exitcode(status)
+        if time.time() > deadline:
+            os.kill(pid, signal.SIGKILL); os.waitpid(pid, 0); return None
+        time.sleep(0.01)
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="requires os.fork")
+def test_forked_child_sessions(tmp_path):
+    path = str(tmp_path / "cache")
+    CacheInit(path); CacheSet(path, "parent", 1)
+    # A child exiting through the `atexit` hook without using the path
+    assert run_forked(cache_close_all) == 0
+    def child():
+        CacheInit(path, clear=False); CacheSet(path, "child", 2); CacheClose(path)
+    assert run_forked(child) == 0
+    assert CacheGet(path, "child") == 2 and CacheGet(path, "parent") == 1
+    CacheClose(path)
+    assert ExistFile(pjoin(path, "cache.clean"))
+
+def evict_worker(args):
+    path, worker = args; errors = 0
+    CacheInit(path, clear=False)
+    for i in range(200):
+        try:
+            CacheSet(path, (worker, i), "x" * 64)
+        except Exception:
+            errors += 1
+    CacheClose(path); return errors
+
+@pytest.mark.parametrize("backend", ["files", "sqlite"])
+def test_eviction_with_several_processes(tmp_path, backend):
+    path = str(tmp_path / "cache")
+    CacheInit(path, backend=backend, policy={'max_entries': 20, 'check_every': 1}); CacheClose(path)
+    with multiprocessing.get_context("spawn").Pool(4) as pool:
+        assert pool.map(evict_worker, [(path, worker) for worker in range(4)]) == [0, 0, 0, 0]
+    CacheInit(path, clear=False); CacheEvict(path)
+    assert len(list(CacheKeys(path))) <= 20
+    CacheClose(path)
+
+def test_sqlite_backend_reopen(tmp_path):
+    path = str(tmp_path / "cache")
+    CacheInit(path, backend="sqlite")
+    CacheSet(path, "a", [1, 2, 3]); CacheSet(path, ("b", 2), {'x': None}); CacheSet(path, "c", 3); CacheDelete(path, "c")
+    CacheClose(path)
+    CacheInit(path, clear=False)
+    assert CacheLoadConfig(path)['backend'] == "sqlite"
+    assert CacheGet(path, "a") == [1, 2, 3] and CacheGet(path, ("b", 2)) == {'x': None}
+    assert not CacheExist(path, "c") and CacheGet(path, "c", default="missing") == "missing"
+    assert sorted(map(str, CacheKeys(path))) == ["('b', 2)", "a"]
+    CacheClose(path)
+
+def test_read_baseline_entries(tmp_path):
+    # Entries written by earlier versions: `<md5(str(key))>.key` and `.value` files holding plain pickles
+    path = str(tmp_path / "cache"); CreateFolder(path)
+    for key, value in [("a", 1), (("b", 2), [3, 4])]:
+        SavePickle(key, pjoin(path, f"{MD5(key)}.key")); SavePickle(value, pjoin(path, f"{MD5(key)}.value"))
+    CacheInit(path, clear=False)
+    assert CacheGet(path, "a") == 1 and CacheGet(path, ("b", 2)) == [3, 4]
+    assert sorted(map(str, CacheKeys(path))) == ["('b', 2)", "a"]
+    CacheSet(path, "a", 5); assert CacheGet(path, "a") == 5
+    CacheClose(path)
+
+def test_corrupt_entries_are_misses(tmp_path):
+    path = str(tmp_path / "cache")
+    CacheInit(path); CacheSet(path, "truncated", "x" * 1000); CacheSet(path, "flipped", "y" * 1000)
+    store = CacheGetStore(path)
+    value = store.file(store.hash("truncated"), 'value'); data = open(value, "rb").read()
+    with open(value, "wb") as f:
+        f.write(data[:len(data) // 2])
+    value = store.file(store.hash("flipped"), 'value'); data = bytearray(open(value, "rb").read()); data[-1] ^= 0xff
+    with open(value, "wb") as f:
+        f.write(bytes(data))
+    assert CacheGet(path, "truncated", default="missing") == "missing"
+    assert CacheGet(path, "flipped", default="missing") == "missing"
+    CacheSet(path, "flipped", 1); assert CacheGet(path, "flipped") == 1
+    # Interrupted writes leave temporary files and values without keys, which the integrity check removes
+    orphan = store.file(store.hash("orphan"), 'value'); tmp = store.file(store.hash("tmp"), 'key') + ".1-2.tmp"
+    for file in [orphan, tmp]:
+        with open(file, "wb") as f:
+            f.write(b"partial")
+    CacheClose(path); CacheInit(path, clear=False, recover=True)
+    assert not ExistFile(orphan) and not ExistFile(tmp) and CacheGet(path, "flipped") == 1
+    CacheClose(path)
+
+def in_thread(f):
+    # Run `f` in another thread, which holds its own locks
+    result = list(); thread = threading.Thread(target=lambda: result.append(f())); thread.start(); thread.join(); return result[0]
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="requires fcntl and os.fork")
+def test_flock_shared_and_exclusive(tmp_path):
+    path = str(tmp_path / "cache"); CacheInit(path, lock_mode="flock")
+    assert CacheLock(path, "k", shared=True) and not CacheLock(path, "k", shared=True)
+    assert in_thread(lambda: CacheLock(path, "k", shared=True) and (CacheUnlock(path, "k") or True))
+    assert not in_thread(lambda: CacheLock(path, "k"))
+    assert run_forked(lambda: os._exit(0 if not CacheLock(path, "k") else 1)) == 0
+    assert CacheLock(path, "other")
+    CacheUnlock(path, "k"); CacheUnlock(path, "other")
+    assert os.listdir(pjoin(path, "locks")) == []
+    # An exclusive lock blocks other holders until it is released
+    assert CacheLock(path, "k")
+    assert not in_thread(lambda: CacheLock(path, "k", shared=True))
+    waited = list(); thread = threading.Thread(target=lambda: waited.append(CacheWait(path, "k", shared=True)) or CacheUnlock(path, "k")); thread.start()
+    time.sleep(0.2); assert not waited
+    CacheUnlock(path, "k"); thread.join(5.0); assert waited == [True]
+    assert run_forked(lambda: os._exit(0 if CacheLock(path, "k") else 1)) == 0
+    CacheClose(path)
+
+def test_migrate_layout_round_trip(tmp_path):
+    path = str(tmp_path / "cache"); CacheInit(path)
+    items = {f"key{i}": i for i in range(50)}
+    for key, value in items.items():
+        CacheSet(path, key, value)
+    with pytest.raises(Exception):
+        CacheInit(path, clear=False, layout="sharded")
+    CacheMigrateLayout(path, "sharded")
+    assert CacheLoadConfig(path)['layout'] == "sharded"
+    assert not any(name.endswith(".key") for name in os.listdir(path))
+    assert {key: CacheGet(path, key) for key in items} == items
+    CacheSet(path, "new", -1)
+    CacheMigrateLayout(path, "flat")
+    assert 'layout' not in CacheLoadConfig(path)
+    assert sum(name.endswith(".key") for name in os.listdir(path)) == 51
+    assert {key: CacheGet(path, key) for key in items} == items and CacheGet(path, "new") == -1
+    CacheClose(path)
+
+def test_freeze_and_open_frozen(tmp_path):
+    path = str(tmp_path / "cache"); out = str(tmp_path / "cache.frozen")
+    CacheInit(path, policy={'max_entries': 1000})
+    items = {f"key{i}": {'value': i} for i in range(100)}
+    for key, value in items.items():
+        CacheSet(path, key, value)
+    CacheSet(path, "expired", 0, ttl=0.01); time.sleep(0.05)
+    CacheFreeze(path, out, codec="zlib")
+    frozen = CacheOpenFrozen(out)
+    assert len(frozen) == 100 and "key7" in frozen and "expired" not in frozen
+    assert {key: frozen.get(key) for key in items} == items
+    assert frozen.get("missing", default="missing") == "missing"
+    assert sorted(frozen.keys()) == sorted(items) and dict(frozen.items()) == items
+    assert CacheOpenFrozen(out) is frozen
+    # Freezing again replaces the file, which is reopened
+    CacheSet(path, "key0", "changed"); CacheFreeze(path, out)
+    assert CacheOpenFrozen(out).get("key0") == "changed"
+    CacheClose(path)
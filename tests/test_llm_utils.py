@@ -0,0 +1,152 @@
+import os
+import sys
+import json
+import time
+import asyncio
+
+import pytest
+
+from pyheaven import *
+
+def test_query_batch_keeps_order_and_failures(llm, stub):
+    stub.fail = lambda body: "bad" in body['messages'][-1]['content']
+    prompts = [f"p{i}" for i in range(20)] + ["bad prompt", "last"]
+    responses = LLMQueryBatch(llm, prompts, max_concurrency=4, retry_time=1, retry_gap=0.0)
+    assert responses[:20] == [f"echo: p{i}" for i in range(20)]
+    assert isinstance(responses[20], Exception)
+    assert responses[21] == "echo: last"
+
+def test_query_batch_bounds_concurrency(llm, stub):
+    stub.delay = 0.05
+    LLMQueryBatch(llm, [f"p{i}" for i in range(24)], max_concurrency=4)
+    assert stub.calls == 24
+    assert 1 < stub.peak <= 4
+
+def test_query_batch_shares_cache(llm, stub):
+    assert LLMQuery(llm, "cached") == "echo: cached"
+    assert LLMQueryBatch(llm, ["cached", "new", "new"]) == ["echo: cached", "echo: new", "echo: new"]
+    calls = stub.calls
+    assert asyncio.run(LLMQueryAsync(llm, "new")) == "echo: new"
+    assert LLMQuery(llm, "new") == "echo: new"
+    assert stub.calls == calls
+
+def test_clients_shared_by_backend_name(llm):
+    assert LLMClient(llm) is LLMClient(llm, "deepseek-api")
+
+def test_async_clients_closed_with_loop(llm, stub):
+    async def query():
+        await LLMQueryAsync(llm, "x"); client = LLMClientAsync(llm)
+        assert client is LLMClientAsync(llm) is LLMClientAsync(llm, "deepseek-api") and not client.is_closed()
+        # A client whose arguments changed is replaced and closed
+        config = LoadJson(pjoin(llm, "config.json")); config['deepseek-api']['api_key'] = "another stub key"; SaveJson(config, pjoin(llm, "config.json"), indent=4)
+        replaced = LLMClientAsync(llm); await asyncio.sleep(0.1)
+        assert replaced is not client and client.is_closed()
+        return replaced
+    assert asyncio.run(query()).is_closed()
+
+def test_cache_lookup_prefix(llm, stub):
+    shared = [{'role': "system", 'content': "You are helpful."}, {'role': "user", 'content': "Example"}, {'role': "assistant", 'content': "Answer"}]
+    for question in ["q1", "q2"]:
+        LLMQuery(llm, shared + [{'role': "user", 'content': question}])
+    LLMQuery(llm, [{'role': "system", 'content': "You are terse."}, {'role': "user", 'content': "q3"}])
+    assert sorted(response['content'] for _, response in LLMCacheLookupPrefix(llm, shared)) == ["echo: q1", "echo: q2"]
+    assert len(list(LLMCacheLookupPrefix(llm, None, prefix=LLMFingerprint(shared[:1])))) == 2
+    assert len(list(LLMCacheLookupPrefix(llm, shared[:1], model="other"))) == 0
+    assert len(list(LLMCacheLookupPrefix(llm, [{'role': "system", 'content': "You are terse."}]))) == 1
+
+def test_fingerprint_is_stable():
+    messages = [{'role': "system", 'content': "You are helpful."}, {'role': "user", 'content': "Hi"}]
+    chain = LLMFingerprint(messages)
+    assert len(chain) == 2 and all(len(fingerprint) == 16 for fingerprint in chain)
+    assert chain == LLMFingerprint([dict(messages[0]), dict(messages[1])])
+    assert chain == LLMFingerprint([{'content': m['content'], 'role': m['role']} for m in messages])
+    assert LLMFingerprint("Hi") == LLMFingerprint([{'role': "user", 'content': "Hi"}])
+    assert LLMFingerprint(messages[1:], prefix=LLMFingerprint(messages[:1])) == chain
+    assert LLMFingerprint(messages[:1])[0] == chain[0]
+    assert LLMFingerprint([messages[0], {'role': "user", 'content': "Hi!"}])[1] != chain[1]
+    assert LLMFingerprint(messages[::-1])[1] != chain[1]
+
+def test_batch_offline_results_fill_cache(llm, stub, tmp_path):
+    assert LLMQuery(llm, "cached") == "echo: cached"
+    name = LLMBatchSubmit(llm, ["cached", "a", "b", "a", "bad"], submit=False)
+    with open(pjoin(llm, "batches", name, "requests.jsonl"), "r", encoding="utf-8") as f:
+        requests = [json.loads(line) for line in f]
+    assert sorted(request['body']['messages'][-1]['content'] for request in requests) == ["a", "b", "bad"]
+    output_file = str(tmp_path / "output.jsonl")
+    with open(output_file, "w", encoding="utf-8") as f:
+        for request in requests:
+            content = request['body']['messages'][-1]['content']
+            if content == "bad":
+                f.write(json.dumps({'custom_id': request['custom_id'], 'response': None, 'error': {'code': "server_error", 'message': "failed"}}) + "\n")
+            else:
+                f.write(json.dumps({'custom_id': request['custom_id'], 'response': {'status_code': 200, 'body': {'choices': [{'message': {'role': "assistant", 'content': "batch: " + content}}]}}}) + "\n")
+    assert LLMBatchCollect(llm, name, output_file=output_file) == ["echo: cached", "batch: a", "batch: b", "batch: a", None]
+    calls = stub.calls
+    assert LLMQuery(llm, "a") == "batch: a" and LLMQuery(llm, "b") == "batch: b"
+    assert stub.calls == calls
+
+def test_semantic_cache_disabled_by_default(llm, stub):
+    LLMQuery(llm, "hello  world"); LLMQuery(llm, "hello world")
+    assert stub.calls == 2
+
+def test_semantic_cache_hits_and_misses(tmp_path, stub):
+    path = str(tmp_path / "semantic")
+    LLMInit(path, config={}, clear=False, deepseek_api_key="stub", deepseek_base_url=stub.url,
+        semantic_cache={'normalizers': ["timestamps", "uuids", "whitespace", {'pattern': r"req-\d+", 'repl': "<REQ>"}], 'index': "minhash", 'threshold': 0.8})
+    base = "Summarize request req-123 at 2024-01-02T03:04:05Z with id 123e4567-e89b-12d3-a456-426614174000. " + " ".join(f"line {i} event happened normally" for i in range(60))
+    response = LLMQuery(path, base); assert stub.calls == 1
+    # Prompts identical after normalization
+    assert LLMQuery(path, base.replace("req-123", "req-999").replace("2024-01-02T03:04:05Z", "2025-05-05T00:00:00Z").replace(" at ", "   at\n")) == response
+    assert LLMSemanticLookup(path, base.replace("req-123", "req-5")) == (response, 1.0)
+    # Near-duplicate prompts through the MinHash index
+    near = base.replace("line 7 event", "line 7 incident").replace("line 21 event", "line 21 incident").replace("line 42 event", "line 42 incident")
+    content, similarity = LLMSemanticLookup(path, near)
+    assert content == response and 0.8 <= similarity < 1.0
+    assert LLMQuery(path, near) == response and stub.calls == 1
+    # Different prompts and sampling parameters are misses
+    assert LLMSemanticLookup(path, "Translate this poem into French: roses are red, violets are blue") == (None, None)
+    LLMQuery(path, "Translate this poem into French: roses are red, violets are blue"); assert stub.calls == 2
+    LLMQuery(path, base, temperature=0.7); assert stub.calls == 3
+
+def token_command(tmp_path, output):
+    # A token command counting its runs in `runs.txt`, printing `output` formatted with the run number
+    script = tmp_path / "token.py"; runs = tmp_path / "runs.txt"
+    script.write_text(f"import os\nn = int(open({str(runs)!r}).read()) + 1 if os.path.exists({str(runs)!r}) else 1\nopen({str(runs)!r}, 'w').write(str(n))\nprint({output!r}.replace('<n>', str(n)))\n")
+    return f'"{sys.executable}" "{script}"', lambda: int(runs.read_text()) if runs.exists() else 0
+
+def test_token_refresher_reuses_valid_token(tmp_path):
+    command, runs = token_command(tmp_path, '{"access_token": "tok-<n>", "expires_in": 100}')
+    refresher = LLMTokenRefresher(str(tmp_path), "stub", command)
+    try:
+        assert refresher.token() == "tok-1" and refresher.token() == "tok-1"
+        state = LoadJson(refresher.file)
+        assert state['renew'] == pytest.approx(state['expires'] - 25.0)
+        assert LLMTokenRefresher(str(tmp_path), "stub", command).token() == "tok-1"
+        assert runs() == 1
+    finally:
+        refresher.stop()
+
+def test_token_refresher_renews_expired_token(tmp_path):
+    command, runs = token_command(tmp_path, "tok-<n>")
+    refresher = LLMTokenRefresher(str(tmp_path), "stub", command, lifetime=3600)
+    try:
+        assert refresher.token() == "tok-1"
+        assert LoadJson(refresher.file)['expires'] == pytest.approx(time.time() + 3600, abs=60)
+        tmp = refresher.file + ".expired"; SaveJson({'token': "tok-1", 'expires': time.time() - 1, 'renew': time.time() - 1}, tmp); os.replace(tmp, refresher.file)
+        assert refresher.token() == "tok-2" and runs() == 2
+    finally:
+        refresher.stop()
+
+def test_token_refresher_keeps_last_error(tmp_path):
+    refresher = LLMTokenRefresher(str(tmp_path), "stub", f'"{sys.executable}" -c "import sys; sys.exit(3)"')
+    try:
+        refresher.start()
+        for _ in range(100):
+            if refresher.last_error is not None:
+                break
+            time.sleep(0.05)
+        assert isinstance(refresher.last_error, AssertionError)
+        with pytest.raises(AssertionError):
+            refresher.token()
+    finally:
+        refresher.stop()